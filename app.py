@@ -1,54 +1,110 @@
+import os
+
 import gradio as gr
-from transformers import pipeline
-
-# Initialize pipelines (you might need to download models on first run)
-# speech_to_text_pipeline = pipeline("automatic-speech-recognition", model="openai/whisper-small")
-# llm_pipeline = pipeline("text-generation", model="gpt2-medium") # You might want a more instruction-following model
-# text_to_speech_pipeline = pipeline("text-to-speech", model="facebook/fastspeech2-en-200_speaker0")
-
-def process_video(video_input):
-    pass
-    # if video_input is None:
-    #     return None, None, None, "Please upload a video."
-
-    # # 1. Speech to Text
-    # print("Running Speech to Text...")
-    # transcription = speech_to_text_pipeline(video_input)
-    # text_output = transcription["text"]
-    # print(f"Transcription: {text_output}")
-
-    # # 2. Language Model
-    # print("Running Language Model...")
-    # llm_output = llm_pipeline(text_output, max_length=150, num_return_sequences=1)[0]["generated_text"]
-    # print(f"LLM Output: {llm_output}")
-
-    # # 3. Text to Speech
-    # print("Running Text to Speech...")
-    # speech_output = text_to_speech_pipeline(llm_output)
-    # audio_output = (speech_output["sampling_rate"], speech_output["audio"])
-    # print("Text to Speech complete.")
-
-    # # 4. Lipsync Model (Placeholder)
-    # # In a real application, you would pass the video_input and audio_output
-    # # to a lipsync model here. The output of that model would be a new video
-    # # with synchronized lips. For this example, we'll just return the original video
-    # # and the generated audio.
-    # lipsync_video_output = video_input
-
-    # return lipsync_video_output, audio_output, text_output, llm_output
-
-iface = gr.Interface(
-    fn=process_video,
-    inputs=gr.Video(label="Input Video"),
-    outputs=[
-        gr.Video(label="Lipsynced Video (Placeholder)"),
-        gr.Audio(label="Generated Audio"),
-        gr.Textbox(label="Generated Text (from Speech to Text)"),
-        gr.Textbox(label="LLM Output"),
-    ],
-    live=False,
-    title="Video Processing Pipeline",
-    description="Upload a video to transcribe its audio, process the text with an LLM, generate speech from the LLM output, and (conceptually) lipsync it back to the original video.",
-)
-
-iface.launch(server_port=8000) # Specify the desired port here
\ No newline at end of file
+
+from hashing import cached_file_sha256, params_hash
+from jobs import DONE, FAILED, QUEUED, JobQueue, QueueFull
+from metrics import LogSink, PrometheusSink, metrics
+from pipeline import STAGES, translate_video, warmup_models
+from text_to_speech import melo_language
+
+OUTPUT_DIR = "outputs_app"
+# Translations running at once, and translations allowed to wait for a slot
+MAX_JOBS = int(os.environ.get("APP_MAX_JOBS", 1))
+MAX_QUEUE = int(os.environ.get("APP_MAX_QUEUE", 8))
+# Prometheus /metrics port, and whether to print every span slower than TRACE_MIN_MS
+METRICS_PORT = os.environ.get("METRICS_PORT")
+TRACE_MIN_MS = os.environ.get("TRACE_MIN_MS")
+
+# Only languages melo TTS has a voice for (text_to_speech.MELO_LANGUAGES)
+LANGUAGES = ["Spanish", "French", "English"]
+
+jobs = JobQueue(max_workers=MAX_JOBS, max_queue=MAX_QUEUE)
+
+
+def _status(job):
+    if job.status == FAILED:
+        return f"Failed: {job.error}"
+    if job.status == DONE:
+        return "Done"
+    if job.stage is None:
+        return f"Waiting in queue ({jobs.queued()} waiting)" if job.status == QUEUED else "Starting"
+    step = STAGES.index(job.stage) + 1
+    return f"Step {step}/{len(STAGES)}: {job.stage} {job.fraction:.0%}"
+
+
+def process_video(video_input, target_language):
+    """
+    Submit a translation job and stream its progress and partial results:
+    transcript, then translation, then dubbed audio, then the lipsynced video.
+    """
+    if video_input is None:
+        yield "Please upload a video.", None, None, None, None
+        return
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # Identical uploads with the same settings share one job
+    video_hash = cached_file_sha256(video_input)
+    key = params_hash(video_hash, target_language)
+    try:
+        job = jobs.submit(
+            key,
+            translate_video,
+            video_input,
+            os.path.join(OUTPUT_DIR, f"{key}.mp4"),
+            target_language,
+            avatar_id=f"upload_{video_hash[:16]}",
+            tts_language=melo_language(target_language),
+        )
+    except QueueFull as e:
+        yield f"Server busy: {e}", None, None, None, None
+        return
+
+    for job in job.updates(timeout=5):
+        artifacts = dict(job.artifacts)
+        audio = None
+        if "audio" in artifacts:
+            audio = (artifacts["sample_rate"], artifacts["audio"])
+        yield (
+            _status(job),
+            artifacts.get("transcript"),
+            artifacts.get("translation"),
+            audio,
+            artifacts.get("output_path"),
+        )
+
+
+with gr.Blocks(title="Video Translation Pipeline") as demo:
+    gr.Markdown(
+        "Upload a video to transcribe its audio, translate it, synthesize the translation "
+        "in the speaker's voice and lipsync it back onto the video. Results appear as each step finishes."
+    )
+    with gr.Row():
+        with gr.Column():
+            video_input = gr.Video(label="Input Video")
+            target_language = gr.Dropdown(LANGUAGES, value=LANGUAGES[0], label="Target Language")
+            submit = gr.Button("Translate", variant="primary")
+        with gr.Column():
+            status = gr.Textbox(label="Status")
+            transcript = gr.Textbox(label="Transcript")
+            translation = gr.Textbox(label="Translation")
+            audio_output = gr.Audio(label="Translated Audio")
+            video_output = gr.Video(label="Lipsynced Video")
+    submit.click(
+        process_video,
+        inputs=[video_input, target_language],
+        outputs=[status, transcript, translation, audio_output, video_output],
+    )
+
+
+if __name__ == "__main__":
+    if METRICS_PORT:
+        PrometheusSink().serve(int(METRICS_PORT))
+    if TRACE_MIN_MS:
+        metrics.add_sink(LogSink(min_duration_s=float(TRACE_MIN_MS) / 1000))
+    # Load every model once, including the TTS voice of each language, before the first request arrives
+    for tts_language in sorted({melo_language(language) for language in LANGUAGES}):
+        warmup_models(tts_language)
+    # Event handlers only wait on jobs, so many can stream at once; the job queue bounds the actual work
+    demo.queue(default_concurrency_limit=4 * (MAX_JOBS + MAX_QUEUE), max_size=4 * (MAX_JOBS + MAX_QUEUE))
+    demo.launch(server_port=8000) # Specify the desired port here
@@ -0,0 +1,183 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from workspace import new_request_id, unique_tmp_path
+
+# Bump when the on-disk layout changes; caches with an unknown version are ignored.
+# v1 stored the full mirrored cycle (2N entries), v2 stores only the N unique ones,
+# v3 stores masks shared by a static-head run once.
+FORMAT_VERSION = 3
+SUPPORTED_VERSIONS = (1, 2, 3)
+CACHE_DIR = "cache"
+
+
+class MirroredCycle:
+    """
+    Read-only view of ``items + items[::-1]`` that never materializes the second half.
+    Supports ``len`` and integer indexing (modulo the cycle length), which is all
+    ``datagen`` and the blending loop need.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return 2 * len(self.items)
+
+    def index(self, i):
+        """Map a position in the cycle to the index of the unique entry."""
+        n = len(self.items)
+        i = i % (2 * n)
+        return i if i < n else 2 * n - 1 - i
+
+    def __getitem__(self, i):
+        return self.items[self.index(i)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _read_meta(directory):
+    with open(os.path.join(directory, "meta.json"), "r") as f:
+        return json.load(f)
+
+
+def cache_path(avatar_path):
+    return os.path.join(avatar_path, CACHE_DIR)
+
+
+def exists(avatar_path):
+    if not os.path.exists(os.path.join(cache_path(avatar_path), "meta.json")):
+        return False
+    return _read_meta(cache_path(avatar_path)).get("format_version") in SUPPORTED_VERSIONS
+
+
+def _publish(final_dir, version_dir):
+    """
+    Point ``final_dir`` (a symlink) at ``version_dir`` by renaming a new symlink
+    over it, so readers always see either the old or the new complete cache.
+    The version it replaced is removed afterwards.
+    """
+    previous = None
+    if os.path.islink(final_dir):
+        previous = os.path.join(os.path.dirname(final_dir), os.readlink(final_dir))
+    elif os.path.isdir(final_dir):
+        # Plain directory written before caches were versioned; moved aside once
+        previous = unique_tmp_path(final_dir)
+        os.replace(final_dir, previous)
+    link = unique_tmp_path(final_dir)
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, final_dir)
+    if previous is not None and os.path.abspath(previous) != os.path.abspath(version_dir):
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def save(avatar_path, frames, coords, latents, masks, mask_coords):
+    """
+    Write prepared avatar material as memory-mappable ``.npy`` files.
+    Only the N unique entries are stored; the mirrored cycle is rebuilt on load.
+
+    Layout of ``{avatar_path}/cache/``:
+      frames.npy       uint8 (N, H, W, 3)  full BGR frames
+      coords.npy       int32 (N, 4)        face bbox per frame
+      latents.npy      (N, 1, C, h, w)     stacked UNet input latents
+      masks.npy        uint8 (total,)      distinct masks packed back to back (they differ in size)
+      mask_shapes.npy  int64 (M, 2)        height/width of each distinct mask
+      mask_index.npy   int32 (N,)          distinct mask used by each frame
+      mask_coords.npy  int32 (N, 4)        crop box of each mask
+      meta.json        format version and shapes
+    ``cache`` is a symlink to a versioned sibling directory (``cache-<id>``). A new
+    version is written in full and the link is then swapped atomically, so a
+    crash, a concurrent writer or another process loading the avatar never sees
+    a missing or half-written cache.
+    """
+    final_dir = cache_path(avatar_path)
+    tmp_dir = f"{final_dir}-{new_request_id()}"
+    os.makedirs(tmp_dir)
+
+    frames = np.ascontiguousarray(np.stack(frames), dtype=np.uint8)
+    np.save(os.path.join(tmp_dir, "frames.npy"), frames)
+    np.save(os.path.join(tmp_dir, "coords.npy"), np.asarray(coords, dtype=np.int32).reshape(-1, 4))
+    np.save(os.path.join(tmp_dir, "mask_coords.npy"), np.asarray(mask_coords, dtype=np.int32).reshape(-1, 4))
+
+    if isinstance(latents, (list, tuple)):
+        latents = torch.stack([latent.detach().cpu() for latent in latents])
+    latents = latents.detach().cpu()
+    latents_np = latents.float().numpy() if latents.dtype == torch.bfloat16 else latents.numpy()
+    np.save(os.path.join(tmp_dir, "latents.npy"), latents_np)
+
+    # Frames of a static-head run share one mask object (see avatar_prep.share_static_masks)
+    distinct = {}
+    mask_index = np.asarray([distinct.setdefault(id(mask), (len(distinct), mask))[0] for mask in masks],
+                            dtype=np.int32)
+    np.save(os.path.join(tmp_dir, "mask_index.npy"), mask_index)
+    # Masks read back from legacy PNGs are 3-channel; only one channel is needed
+    masks = [mask[..., 0] if mask.ndim == 3 else mask for _, mask in distinct.values()]
+    mask_shapes = np.asarray([mask.shape[:2] for mask in masks], dtype=np.int64).reshape(-1, 2)
+    packed = np.concatenate([np.ascontiguousarray(mask, dtype=np.uint8).reshape(-1) for mask in masks]) if masks else np.empty((0,), dtype=np.uint8)
+    np.save(os.path.join(tmp_dir, "masks.npy"), packed)
+    np.save(os.path.join(tmp_dir, "mask_shapes.npy"), mask_shapes)
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "cycle": "mirror",
+            "num_frames": int(frames.shape[0]),
+            "num_masks": len(masks),
+            "frame_shape": list(frames.shape[1:]),
+            "latent_shape": list(latents.shape[1:]),
+            "latent_dtype": str(latents_np.dtype),
+        }, f)
+
+    _publish(final_dir, tmp_dir)
+
+
+def load(avatar_path, device="cpu"):
+    """
+    Open a cache written by ``save``. Frames and masks stay memory-mapped, so
+    opening is cheap and processes sharing an avatar share the page cache.
+    :return: (frames, coords, latents, masks, mask_coords) holding the N unique
+        entries: frames is an (N, H, W, 3) memmap, masks is a list of memmap views
+        (one shared view per static-head run) and latents is an (N, 1, C, h, w)
+        tensor on ``device``. Wrap them in ``MirroredCycle`` to get the playback order.
+    """
+    try:
+        return _load(os.path.realpath(cache_path(avatar_path)), device)
+    except FileNotFoundError:
+        # A concurrent save replaced the version being read and removed it; read the new one
+        return _load(os.path.realpath(cache_path(avatar_path)), device)
+
+
+def _load(directory, device):
+    meta = _read_meta(directory)
+    frames = np.load(os.path.join(directory, "frames.npy"), mmap_mode="r")
+    coords = [tuple(c) for c in np.load(os.path.join(directory, "coords.npy")).tolist()]
+    mask_coords = [tuple(c) for c in np.load(os.path.join(directory, "mask_coords.npy")).tolist()]
+    latents = torch.from_numpy(np.load(os.path.join(directory, "latents.npy"))).to(device)
+
+    packed = np.load(os.path.join(directory, "masks.npy"), mmap_mode="r")
+    mask_shapes = np.load(os.path.join(directory, "mask_shapes.npy"))
+    masks = []
+    offset = 0
+    for height, width in mask_shapes.tolist():
+        masks.append(packed[offset:offset + height * width].reshape(height, width))
+        offset += height * width
+    if meta["format_version"] >= 3:
+        masks = [masks[i] for i in np.load(os.path.join(directory, "mask_index.npy")).tolist()]
+
+    if meta["format_version"] == 1:
+        # v1 caches hold the whole mirrored cycle; the first half is the unique part
+        frames, coords, latents, masks, mask_coords = (
+            first_half(frames), first_half(coords), first_half(latents), first_half(masks), first_half(mask_coords)
+        )
+    return frames, coords, latents, masks, mask_coords
+
+
+def first_half(items):
+    """Unique entries of a materialized ``items + items[::-1]`` cycle."""
+    return items[:len(items) // 2]
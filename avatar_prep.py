@@ -0,0 +1,328 @@
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from mmpose.apis import inference_topdown
+from mmpose.structures import merge_data_samples
+from tqdm import tqdm
+
+from hashing import params_hash, path_sha256
+from musetalk.utils import preprocessing
+from musetalk.utils.blending import get_image_prepare_material
+from musetalk.utils.face_parsing import FaceParsing
+from workspace import unique_tmp_path
+
+# maker if the bbox is not sufficient
+coord_placeholder = (0.0, 0.0, 0.0, 0.0)
+
+
+def read_video_frames(video_path, cut_frame=10000000):
+    """
+    Decode a video file, or a directory of png/jpg frames, straight into memory.
+    :return: List of BGR uint8 frames.
+    """
+    if os.path.isdir(video_path):
+        files = sorted(f for f in os.listdir(video_path) if f.split(".")[-1].lower() in ("png", "jpg", "jpeg"))
+        return [cv2.imread(os.path.join(video_path, f)) for f in files]
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) <= cut_frame:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def detect_landmarks(frames, batch_size=8):
+    """
+    Run face detection (batched) and the 2D keypoint model over every frame.
+    :return: List of (face_land_mark, face_box) per frame; both None when no face is found.
+    """
+    detections = []
+    for start in tqdm(range(0, len(frames), batch_size), desc="landmarks"):
+        batch = frames[start:start + batch_size]
+        boxes = preprocessing.fa.get_detections_for_batch(np.asarray(batch))
+        for frame, box in zip(batch, boxes):
+            if box is None:  # no face in the image
+                detections.append((None, None))
+                continue
+            results = merge_data_samples(inference_topdown(preprocessing.model, frame))
+            face_land_mark = results.pred_instances.keypoints[0][23:91].astype(np.int32)
+            detections.append((face_land_mark, tuple(box)))
+    return detections
+
+
+def compute_bboxes(detections, bbox_shift=0):
+    """
+    Turn landmarks into face crop boxes, the same way ``get_landmark_and_bbox`` does.
+    This is the only step that depends on ``bbox_shift``.
+    """
+    coords_list = []
+    for face_land_mark, face_box in detections:
+        if face_land_mark is None:
+            coords_list.append(coord_placeholder)
+            continue
+        half_face_coord = face_land_mark[29].copy()
+        if bbox_shift != 0:
+            half_face_coord[1] = bbox_shift + half_face_coord[1]
+        half_face_dist = np.max(face_land_mark[:, 1]) - half_face_coord[1]
+        upper_bond = max(0, half_face_coord[1] - half_face_dist)
+        x1, y1, x2, y2 = (
+            int(np.min(face_land_mark[:, 0])),
+            int(upper_bond),
+            int(np.max(face_land_mark[:, 0])),
+            int(np.max(face_land_mark[:, 1])),
+        )
+        if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:
+            # if the landmark bbox is not suitable, reuse the detector bbox
+            print("error bbox:", face_box)
+            coords_list.append(face_box)
+        else:
+            coords_list.append((x1, y1, x2, y2))
+    return coords_list
+
+
+def expand_bboxes(coord_list, frames, version, extra_margin):
+    """Apply the v15 extra chin margin to every valid box."""
+    coord_list = list(coord_list)
+    if version != "v15":
+        return coord_list
+    for idx, (bbox, frame) in enumerate(zip(coord_list, frames)):
+        if bbox == coord_placeholder:
+            continue
+        x1, y1, x2, y2 = bbox
+        coord_list[idx] = [x1, y1, x2, min(y2 + extra_margin, frame.shape[0])]
+    return coord_list
+
+
+@torch.no_grad()
+def encode_latents(vae, frames, coord_list, batch_size=16):
+    """
+    Batched version of ``vae.get_latents_for_unet`` over every valid face crop.
+    :return: List of (1, 8, h, w) latents, one per frame with a face.
+    """
+    crops = []
+    for bbox, frame in zip(coord_list, frames):
+        if bbox == coord_placeholder:
+            continue
+        x1, y1, x2, y2 = bbox
+        crops.append(cv2.resize(frame[y1:y2, x1:x2], (256, 256), interpolation=cv2.INTER_LANCZOS4))
+
+    latents = []
+    for start in tqdm(range(0, len(crops), batch_size), desc="vae encode"):
+        batch = crops[start:start + batch_size]
+        masked = torch.cat([vae.preprocess_img(crop, half_mask=True) for crop in batch])
+        ref = torch.cat([vae.preprocess_img(crop, half_mask=False) for crop in batch])
+        latent_batch = torch.cat([vae.encode_latents(masked), vae.encode_latents(ref)], dim=1)
+        latents.extend(latent_batch.split(1))
+    return latents
+
+
+def stabilize_bboxes(coord_list, tolerance=2):
+    """
+    Snap runs of near-static face boxes to one box.
+    Consecutive frames whose box is within ``tolerance`` pixels (on every edge)
+    of the first box of their run reuse that box object, so latents are encoded
+    from the same crop and the masks and crop boxes of the run can be shared.
+    Frames without a face end a run.
+    """
+    coord_list = list(coord_list)
+    anchor = None
+    for idx, bbox in enumerate(coord_list):
+        if bbox == coord_placeholder:
+            anchor = None
+        elif anchor is not None and max(abs(a - b) for a, b in zip(anchor, bbox)) <= tolerance:
+            coord_list[idx] = anchor
+        else:
+            anchor = bbox
+    return coord_list
+
+
+def share_static_masks(mask_list, mask_coords_list, tolerance=2.0):
+    """
+    Store the masks of a static-head run once.
+    Consecutive frames whose mask has the same crop box and shape as the first
+    mask of their run, and differs from it by at most ``tolerance`` (mean
+    absolute difference, 0-255 levels), reuse that mask and crop box object.
+    The avatar cache writes shared masks once and blending reuses their alpha.
+    :return: (mask_list, mask_coords_list)
+    """
+    mask_list, mask_coords_list = list(mask_list), list(mask_coords_list)
+    anchor = None
+    for idx, (mask, crop_box) in enumerate(zip(mask_list, mask_coords_list)):
+        if (anchor is not None and tuple(crop_box) == tuple(mask_coords_list[anchor])
+                and mask.shape == mask_list[anchor].shape
+                and np.mean(cv2.absdiff(mask, mask_list[anchor])) <= tolerance):
+            mask_list[idx] = mask_list[anchor]
+            mask_coords_list[idx] = mask_coords_list[anchor]
+        else:
+            anchor = idx
+    return mask_list, mask_coords_list
+
+
+_worker_fp = None
+
+
+def _init_mask_worker(left_cheek_width, right_cheek_width):
+    global _worker_fp
+    if left_cheek_width is None and right_cheek_width is None:
+        _worker_fp = FaceParsing()
+    else:
+        _worker_fp = FaceParsing(left_cheek_width=left_cheek_width, right_cheek_width=right_cheek_width)
+
+
+def _mask_task(frame, bbox, mode):
+    return get_image_prepare_material(frame, list(bbox), fp=_worker_fp, mode=mode)
+
+
+def compute_masks(frames, coord_list, mode, fp=None, workers=0, left_cheek_width=None, right_cheek_width=None):
+    """
+    Face-parsing blend masks for every frame.
+    With ``workers`` > 1 the frames are spread over a process pool, each worker
+    holding its own FaceParsing model; otherwise ``fp`` is used in-process.
+    :return: (mask_list, mask_coords_list)
+    """
+    if workers <= 1:
+        results = [
+            get_image_prepare_material(frame, list(bbox), fp=fp, mode=mode)
+            for frame, bbox in tqdm(zip(frames, coord_list), total=len(frames), desc="masks")
+        ]
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                 initializer=_init_mask_worker,
+                                 initargs=(left_cheek_width, right_cheek_width)) as executor:
+            results = list(tqdm(
+                executor.map(_mask_task, frames, coord_list, [mode] * len(frames), chunksize=8),
+                total=len(frames),
+                desc="masks",
+            ))
+    mask_list = [mask for mask, _ in results]
+    mask_coords_list = [crop_box for _, crop_box in results]
+    return mask_list, mask_coords_list
+
+
+class StageCache:
+    """
+    On-disk results of individual preparation stages, one file per stage named
+    after the stage key. Files are written atomically, so an interrupted run
+    resumes from the last completed stage, and a stage whose key changed is
+    recomputed and replaces the previous file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, stage, key):
+        return os.path.join(self.directory, f"{stage}-{key}.pkl")
+
+    def load(self, stage, key):
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, stage, key, value):
+        path = self._path(stage, key)
+        tmp_path = unique_tmp_path(path)
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.discard(stage, keep=key)
+
+    def discard(self, stage, keep=None):
+        for name in os.listdir(self.directory):
+            # Leave other writers' in-progress files alone
+            if ".partial-" in name:
+                continue
+            if name.startswith(f"{stage}-") and name != os.path.basename(self._path(stage, keep)):
+                os.remove(os.path.join(self.directory, name))
+
+
+def stage_keys(video_hash, bbox_shift, args):
+    """
+    Cache key of every preparation stage. Each key covers the source video and
+    only the parameters that stage (and the stages it consumes) depends on, so
+    e.g. changing ``bbox_shift`` keeps the landmarks but redoes bbox, latents and masks.
+    Decoded frames are not cached: re-decoding is cheaper than writing them out raw.
+    """
+    keys = {}
+    keys["landmarks"] = params_hash("landmarks", video_hash)
+    keys["bbox"] = params_hash("bbox", keys["landmarks"], bbox_shift, args.version, args.extra_margin,
+                               args.static_bbox_tolerance)
+    keys["latents"] = params_hash("latents", keys["bbox"], args.vae_type)
+    if args.version == "v15":
+        mask_params = (args.parsing_mode, args.left_cheek_width, args.right_cheek_width)
+    else:
+        mask_params = ("raw",)
+    keys["masks"] = params_hash("masks", keys["bbox"], args.version, mask_params, args.static_mask_tolerance)
+    return keys
+
+
+def prepare_avatar_material(video_path, bbox_shift, vae, fp, args, cache_dir=None, video_hash=None):
+    """
+    Build avatar material entirely in memory: decode frames, detect landmarks,
+    batch the VAE encode and compute masks (optionally on a process pool).
+    Runs of near-static frames share one face box, mask and crop box.
+    With ``cache_dir`` every stage result after decoding is stored under its
+    ``stage_keys`` key and reused on the next run, so only invalidated stages are
+    recomputed; the frames are decoded again every time.
+    :param args: Lipsync args; uses version, extra_margin, parsing_mode, vae_type,
+        left/right_cheek_width, prep_vae_batch_size, prep_workers and
+        static_bbox/mask_tolerance.
+    :param video_hash: Content hash of ``video_path`` if already known.
+    :return: (frame_list, coord_list, latent_list, mask_list, mask_coords_list, timings)
+    """
+    timings = {}
+    cache = StageCache(cache_dir) if cache_dir is not None else None
+    if cache is not None:
+        keys = stage_keys(video_hash or path_sha256(video_path), bbox_shift, args)
+        # Raw frames were cached by earlier versions; they can be tens of GB
+        cache.discard("frames")
+
+    def run_stage(stage, compute, cached=True):
+        start_time = time.time()
+        cached = cached and cache is not None
+        value = cache.load(stage, keys[stage]) if cached else None
+        if value is None:
+            value = compute()
+            if cached:
+                cache.save(stage, keys[stage], value)
+        else:
+            print(f"reusing cached {stage} stage")
+        timings[stage] = time.time() - start_time
+        return value
+
+    frames = run_stage("frames", lambda: read_video_frames(video_path), cached=False)
+    detections = run_stage("landmarks", lambda: detect_landmarks(frames))
+    coord_list = run_stage(
+        "bbox", lambda: stabilize_bboxes(
+            expand_bboxes(compute_bboxes(detections, bbox_shift), frames, args.version, args.extra_margin),
+            args.static_bbox_tolerance,
+        )
+    )
+    latent_list = run_stage(
+        "latents", lambda: [latent.cpu() for latent in encode_latents(vae, frames, coord_list, batch_size=args.prep_vae_batch_size)]
+    )
+
+    mode = args.parsing_mode if args.version == "v15" else "raw"
+    cheeks = (args.left_cheek_width, args.right_cheek_width) if args.version == "v15" else (None, None)
+    mask_list, mask_coords_list = run_stage(
+        "masks", lambda: share_static_masks(
+            *compute_masks(frames, coord_list, mode, fp=fp, workers=args.prep_workers,
+                           left_cheek_width=cheeks[0], right_cheek_width=cheeks[1]),
+            args.static_mask_tolerance,
+        )
+    )
+
+    print("avatar preparation timings: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items()))
+    return frames, coord_list, latent_list, mask_list, mask_coords_list, timings
@@ -0,0 +1,340 @@
+"""
+Translate a catalog of videos into several languages in one process.
+
+    python batch_translate.py manifest.jsonl --output_dir outputs_batch
+
+The manifest is a JSON list or has one JSON object per line:
+
+    {"video": "course/lesson1.mp4", "languages": ["es", "fr"]}
+
+Optional fields: ``name`` (output prefix, defaults to the video file name),
+``source_language`` ("en"), ``reference_speaker`` (voice to clone, defaults to
+the video), ``avatar_id`` and ``avatar_video`` (face to lipsync, default to the
+video), ``bbox_shift`` (0) and ``tts_language`` (melo TTS language, a string or
+a dict by target language; derived from the target language by default).
+
+Models are loaded once. Every video is transcribed once and its transcript is
+shared by all its target languages, and every avatar is prepared once. ASR,
+translation + TTS and lipsync run on their own threads connected by bounded
+queues, so the next video is transcribed on the CPU while the accelerator
+lipsyncs the previous one. Each finished job (one video, one language) is
+appended to ``{output_dir}/results.jsonl``; running the same command again
+skips jobs that are done and retries the ones that failed.
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from types import SimpleNamespace
+
+from hashing import cached_file_sha256
+from jobs import DONE, FAILED
+from lipsync_service import LipsyncService
+from metrics import metrics
+from pipeline import dub_transcript, lipsync_video, transcribe_video, warmup_models
+from speech_to_text import TranscriptSegment
+from text_to_speech import melo_language
+from workspace import unique_tmp_path
+
+# Put on a stage queue after the last item
+_END = None
+
+
+def read_manifest(path):
+    """
+    Parse a batch manifest (see the module docstring).
+    :return: List of entries with every optional field filled in.
+    """
+    with open(path, "r") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        items = json.loads(text)
+    else:
+        items = [json.loads(line) for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+
+    entries = []
+    for item in items:
+        if "video" not in item or not item.get("languages"):
+            raise ValueError(f"Manifest entry needs 'video' and 'languages': {item}")
+        stem = os.path.splitext(os.path.basename(item["video"]))[0]
+        languages = item["languages"]
+        entries.append(SimpleNamespace(
+            video=item["video"],
+            name=item.get("name", stem),
+            languages=[languages] if isinstance(languages, str) else list(languages),
+            source_language=item.get("source_language", "en"),
+            reference_speaker=item.get("reference_speaker") or item["video"],
+            avatar_id=item.get("avatar_id") or stem,
+            avatar_video=item.get("avatar_video") or item["video"],
+            bbox_shift=item.get("bbox_shift", 0),
+            tts_language=item.get("tts_language"),
+        ))
+
+    names = [entry.name for entry in entries]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Manifest entries share output names {duplicates}; set 'name' to tell them apart")
+    return entries
+
+
+def job_id(entry, language):
+    return f"{entry.name}:{language}"
+
+
+def tts_language_for(entry, language):
+    """The entry's ``tts_language`` override for ``language``, else the melo model for it."""
+    override = entry.tts_language.get(language) if isinstance(entry.tts_language, dict) else entry.tts_language
+    return override or melo_language(language)
+
+
+class ResultsLog:
+    """
+    Append-only results manifest with one JSON record per finished job.
+    When a job appears more than once (it was retried), the last record wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line cut short by a crash
+                        continue
+                    self.records[record["job"]] = record
+
+    def is_done(self, job, video_sha256):
+        record = self.records.get(job)
+        return (record is not None and record["status"] == DONE and record.get("video_sha256") == video_sha256
+                and os.path.exists(record["output_path"]))
+
+    def write(self, record):
+        with self._lock:
+            self.records[record["job"]] = record
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def load_transcript(path, video_sha256, language):
+    """Transcript stored by ``save_transcript`` for this video content and language, or None."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        data = json.load(f)
+    if data.get("video_sha256") != video_sha256 or data.get("language") != language:
+        return None
+    segments = [TranscriptSegment(*segment) for segment in data["segments"]]
+    return SimpleNamespace(audio=None, duration=data["duration"], segments=segments,
+                           transcript=" ".join(segment.text for segment in segments))
+
+
+def save_transcript(path, video_sha256, language, transcription):
+    tmp_path = unique_tmp_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "video_sha256": video_sha256,
+            "language": language,
+            "duration": transcription.duration,
+            "segments": [list(segment) for segment in transcription.segments],
+        }, f)
+    os.replace(tmp_path, path)
+
+
+class BatchTranslator:
+    """
+    Run every pending (video, language) job of a manifest through a three-stage
+    pipeline sharing one set of models. Failures are recorded per job and do
+    not stop the batch.
+    """
+
+    def __init__(self, entries, output_dir, fps=25, queue_size=2, **lipsync_options):
+        self.entries = entries
+        self.output_dir = output_dir
+        self.fps = fps
+        self.queue_size = queue_size
+        self.lipsync_options = lipsync_options
+        self.transcripts_dir = os.path.join(output_dir, "transcripts")
+        os.makedirs(self.transcripts_dir, exist_ok=True)
+        self.results = ResultsLog(os.path.join(output_dir, "results.jsonl"))
+        self.service = None
+
+    def output_path(self, entry, language):
+        return os.path.join(self.output_dir, f"{entry.name}_{language}.mp4")
+
+    def _record(self, entry, language, video_sha256, status, start_time, error=None, **fields):
+        self.results.write({
+            "job": job_id(entry, language),
+            "video": entry.video,
+            "video_sha256": video_sha256,
+            "target_language": language,
+            "status": status,
+            "output_path": self.output_path(entry, language),
+            "error": error,
+            "seconds": round(time.time() - start_time, 2),
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            **fields,
+        })
+        metrics.increment("batch_jobs_total", status=status)
+        print(f"[{status}] {job_id(entry, language)}" + (f": {error}" if error else ""))
+
+    def pending(self):
+        """
+        (entry, video_sha256, languages still to do) for every entry with work left.
+        Entries whose video cannot be read are recorded as failed.
+        """
+        work = []
+        for entry in self.entries:
+            start_time = time.time()
+            try:
+                video_sha256 = cached_file_sha256(entry.video)
+            except OSError as e:
+                for language in entry.languages:
+                    self._record(entry, language, None, FAILED, start_time, error=f"video: {e}")
+                continue
+            languages = [language for language in entry.languages
+                         if not self.results.is_done(job_id(entry, language), video_sha256)]
+            if languages:
+                work.append((entry, video_sha256, languages))
+            else:
+                print(f"skipping {entry.name}: all languages done")
+        return work
+
+    def _asr_stage(self, work, out_queue):
+        try:
+            for entry, video_sha256, languages in work:
+                start_time = time.time()
+                path = os.path.join(self.transcripts_dir, f"{entry.name}.json")
+                try:
+                    transcription = load_transcript(path, video_sha256, entry.source_language)
+                    if transcription is None:
+                        transcription = transcribe_video(entry.video, language=entry.source_language)
+                        save_transcript(path, video_sha256, entry.source_language, transcription)
+                        # Only the segments travel further; drop the decoded audio
+                        transcription.audio = None
+                    else:
+                        print(f"reusing transcript of {entry.name}")
+                except Exception as e:
+                    traceback.print_exc()
+                    for language in languages:
+                        self._record(entry, language, video_sha256, FAILED, start_time, error=f"asr: {e}")
+                    continue
+                out_queue.put((entry, video_sha256, languages, transcription))
+        finally:
+            out_queue.put(_END)
+
+    def _dub_stage(self, in_queue, out_queue):
+        try:
+            while True:
+                item = in_queue.get()
+                if item is _END:
+                    break
+                entry, video_sha256, languages, transcription = item
+                for language in languages:
+                    start_time = time.time()
+                    try:
+                        dubbed = dub_transcript(
+                            transcription.segments, transcription.duration, entry.source_language, language,
+                            entry.reference_speaker, tts_language=tts_language_for(entry, language),
+                        )
+                    except Exception as e:
+                        traceback.print_exc()
+                        self._record(entry, language, video_sha256, FAILED, start_time, error=f"dub: {e}")
+                        continue
+                    out_queue.put((entry, video_sha256, language, transcription, dubbed, start_time))
+        finally:
+            out_queue.put(_END)
+
+    def _lipsync_stage(self, in_queue):
+        while True:
+            item = in_queue.get()
+            if item is _END:
+                break
+            entry, video_sha256, language, transcription, dubbed, start_time = item
+            output_path = self.output_path(entry, language)
+            try:
+                lipsync_video(
+                    lambda audio, sink: self.service.inference(
+                        entry.avatar_id, audio, sink=sink, fps=self.fps,
+                        video_path=entry.avatar_video, bbox_shift=entry.bbox_shift,
+                    ),
+                    output_path, dubbed, transcription.duration, fps=self.fps, avatar_id=entry.avatar_id,
+                )
+            except Exception as e:
+                traceback.print_exc()
+                self._record(entry, language, video_sha256, FAILED, start_time, error=f"lipsync: {e}")
+                continue
+            self._record(entry, language, video_sha256, DONE, start_time,
+                         transcript=transcription.transcript, translation=dubbed.translation)
+
+    def run(self):
+        """
+        Process every pending job. ASR and dubbing run on background threads;
+        lipsync runs on the calling thread, one job at a time.
+        :return: ``records()`` once every job has finished.
+        """
+        work = self.pending()
+        if not work:
+            return self.records()
+        tts_language = tts_language_for(work[0][0], work[0][2][0])
+        warmup_models(tts_language, **self.lipsync_options)
+        self.service = LipsyncService(fps=self.fps, **self.lipsync_options)
+
+        transcripts = queue.Queue(maxsize=self.queue_size)
+        dubbed = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._asr_stage, args=(work, transcripts), name="batch-asr", daemon=True),
+            threading.Thread(target=self._dub_stage, args=(transcripts, dubbed), name="batch-dub", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            self._lipsync_stage(dubbed)
+            for thread in threads:
+                thread.join()
+        finally:
+            self.service.close()
+        return self.records()
+
+    def records(self):
+        """Latest result record of every job in the manifest that has one."""
+        jobs = [job_id(entry, language) for entry in self.entries for language in entry.languages]
+        return {job: self.results.records[job] for job in jobs if job in self.results.records}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSON/JSONL manifest of videos and target languages")
+    parser.add_argument("--output_dir", default="outputs_batch")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--batch_size", type=int, default=20)
+    parser.add_argument("--gpu_id", type=int, default=0)
+    parser.add_argument("--backend", default="auto", help="UNet/VAE inference backend (see inference_backend.py)")
+    parser.add_argument("--queue_size", type=int, default=2, help="Videos/jobs buffered between stages")
+    args = parser.parse_args()
+
+    translator = BatchTranslator(
+        read_manifest(args.manifest),
+        args.output_dir,
+        fps=args.fps,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        gpu_id=args.gpu_id,
+        backend=args.backend,
+    )
+    records = translator.run()
+    failed = [job for job, record in records.items() if record["status"] == FAILED]
+    print(f"{len(records) - len(failed)} jobs done, {len(failed)} failed; results in "
+          f"{translator.results.path}")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from device_io import decode_frames_async
+from metrics import metrics
+
+
+class _WorkItem:
+    def __init__(self, whisper_batch, latent_batch, out_queue):
+        self.whisper_batch = whisper_batch
+        self.latent_batch = latent_batch
+        self.out_queue = out_queue
+        self.size = latent_batch.shape[0]
+        # Frames already assigned to a forward pass; a batch may be split across two
+        self.taken = 0
+        self.future = Future()
+        self.enqueued_at = time.time()
+
+
+class BatchScheduler:
+    """
+    Combine UNet/VAE work from concurrent lipsync requests into shared forward passes.
+
+    Requests ``submit`` their (whisper features, latents) batches; a single worker
+    thread merges queued frames, possibly from different avatars, until
+    ``max_batch`` frames are collected or the oldest batch has waited ``max_wait_ms``.
+    It then runs one PositionalEncoding + UNet forward and one VAE decode, and puts
+    each decoded frame on the frame queue of the request it belongs to, in order.
+
+    Batches are split at frame level: a batch that does not fit is cut at
+    ``max_batch`` and its remaining frames open the next forward pass, which still
+    takes whatever other batches are already queued. A ``max_batch`` that is a
+    multiple of the requests' batch size lets full batches share a pass without
+    being cut.
+    """
+
+    def __init__(self, unet, vae, pe, device, max_batch=32, max_wait_ms=10):
+        self.unet = unet
+        self.vae = vae
+        self.pe = pe
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.timesteps = torch.tensor([0], device=device)
+
+        self._queue = queue.Queue()
+        self._carry = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, whisper_batch, latent_batch, out_queue):
+        """
+        Queue one batch of frames. Decoded frames are put on ``out_queue``.
+        :return: Future resolved with the number of frames once they are queued.
+        """
+        if self._stopped:
+            raise RuntimeError("BatchScheduler is closed")
+        item = _WorkItem(whisper_batch, latent_batch, out_queue)
+        self._queue.put(item)
+        metrics.set_gauge("batch_queue_depth", self._queue.qsize())
+        return item.future
+
+    def close(self):
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_item(self, timeout=None):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                break
+            parts = []
+            size = 0
+            deadline = item.enqueued_at + self.max_wait
+            stop = False
+            while True:
+                take = min(item.size - item.taken, self.max_batch - size)
+                parts.append((item, item.taken, item.taken + take))
+                item.taken += take
+                size += take
+                if item.taken < item.size:
+                    # The rest of this batch opens the next pass, ahead of anything queued after it
+                    self._carry = item
+                    break
+                if size >= self.max_batch:
+                    break
+                # Past the deadline, still merge batches that are already waiting
+                timeout = max(0.0, deadline - time.time())
+                try:
+                    item = self._next_item(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+            self._run(parts)
+            if stop:
+                break
+
+    @torch.no_grad()
+    def _run(self, parts):
+        """:param parts: (item, start, end) frame ranges of the queued batches to run together."""
+        now = time.time()
+        for item, start, _ in parts:
+            if start == 0:
+                metrics.observe("batch_queue_wait_seconds", now - item.enqueued_at)
+        try:
+            whisper_batch = torch.cat([item.whisper_batch[start:end] for item, start, end in parts]).to(self.device)
+            latent_batch = torch.cat([item.latent_batch[start:end] for item, start, end in parts]).to(
+                device=self.device, dtype=self.unet.model.dtype)
+            with metrics.span("unet", batch=len(latent_batch), requests=len(parts)):
+                audio_feature_batch = self.pe(whisper_batch)
+                pred_latents = self.unet.model(latent_batch,
+                                               self.timesteps,
+                                               encoder_hidden_states=audio_feature_batch).sample
+            recon = decode_frames_async(self.vae, pred_latents).result()
+        except Exception as e:
+            for item, _, _ in parts:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        offset = 0
+        for item, start, end in parts:
+            if item.future.done():
+                # An earlier part of this batch failed; its frames would arrive out of order
+                offset += end - start
+                continue
+            for res_frame in recon[offset:offset + end - start]:
+                item.out_queue.put(res_frame)
+            offset += end - start
+            if end == item.size:
+                item.future.set_result(item.size)
@@ -0,0 +1,576 @@
+"""
+End-to-end benchmark of the translation pipeline, stage by stage.
+
+By default every stage runs on CPU with synthetic video/audio and lightweight
+stand-in models, so results reflect the pipeline code (chunking, batching,
+blending, encoding, I/O) rather than model speed, and the suite runs anywhere.
+``--real_models`` uses the registered models instead.
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json   # exit code 1 on regressions
+
+Stages whose optional dependencies are missing are reported as skipped; a
+stage that raises anything else is reported as failed and the exit code is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import numpy as np
+
+SAMPLING_RATE = 16000
+
+
+class MissingDependency(Exception):
+    """A stage needs an optional tool that is not installed; reported as skipped."""
+
+
+# ---------------------------------------------------------------- measurement
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _write_bytes():
+    """Bytes this process caused to be written to storage, or None if unknown."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class _RssSampler:
+    """Track the peak resident set size while a stage runs."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) == 0:
+        return {}
+    return {
+        "mean": float(np.mean(samples)),
+        "p50": float(np.percentile(samples, 50)),
+        "p90": float(np.percentile(samples, 90)),
+        "p99": float(np.percentile(samples, 99)),
+        "min": float(np.min(samples)),
+        "max": float(np.max(samples)),
+    }
+
+
+def run_stage(name, bench, ctx, repeat, warmup):
+    """
+    Run ``bench(ctx, workdir)`` ``warmup + repeat`` times. ``bench`` returns a
+    dict with ``items`` (frames, segments... processed) and optionally
+    ``item_latencies`` (seconds, e.g. per batch or per segment).
+    A stage whose optional dependencies are missing is "skipped"; any other
+    exception makes it "failed".
+    """
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-", dir=ctx.workdir)
+    try:
+        for _ in range(warmup):
+            bench(ctx, workdir)
+        latencies, item_latencies, items, extra = [], [], 0, {}
+        write_before = _write_bytes()
+        with _RssSampler() as rss:
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                result = bench(ctx, workdir)
+                latencies.append(time.perf_counter() - start_time)
+                items = result.pop("items", 0)
+                item_latencies.extend(result.pop("item_latencies", []))
+                extra = result
+        write_after = _write_bytes()
+    except (ImportError, MissingDependency) as e:
+        return {"status": "skipped", "reason": f"{type(e).__name__}: {e}"}
+    except Exception as e:
+        traceback.print_exc()
+        return {"status": "failed", "reason": f"{type(e).__name__}: {e}"}
+    finally:
+        output_bytes = _dir_bytes(workdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    median = float(np.median(latencies))
+    report = {
+        "status": "ok",
+        "repeat": repeat,
+        "items": items,
+        "items_per_s": items / median if median > 0 else None,
+        "latency_s": percentiles(latencies),
+        "peak_rss_bytes": rss.peak,
+        "disk_write_bytes": None if write_before is None else (write_after - write_before) // repeat,
+        "output_bytes": output_bytes,
+    }
+    if item_latencies:
+        report["item_latency_s"] = percentiles(item_latencies)
+    report.update(extra)
+    return report
+
+
+# ------------------------------------------------------------ synthetic input
+
+def synthetic_speech(duration_s, seed=0):
+    """Voiced harmonic bursts at a syllable-like rate, separated by pauses."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_s * SAMPLING_RATE)) / SAMPLING_RATE
+    pitch = 120 + 20 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLING_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    # 2 s of speech, then 0.7 s of pause
+    speaking = (t % 2.7) < 2.0
+    audio = 0.3 * voiced * syllables * speaking + 0.003 * rng.standard_normal(len(t))
+    return audio.astype(np.float32)
+
+
+def synthetic_avatar(num_frames, size=256, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+    frames = np.stack([np.roll(base, i, axis=1) for i in range(num_frames)])
+    box = (size // 4, size // 4, 3 * size // 4, 7 * size // 8)
+    coords = [box] * num_frames
+    crop_box = (box[0] - 16, box[1] - 16, box[2] + 16, box[3] + 16)
+    mask = np.zeros((crop_box[3] - crop_box[1], crop_box[2] - crop_box[0]), dtype=np.uint8)
+    mask[16:-16, 16:-16] = 255
+    masks = [mask] * num_frames
+    mask_coords = [crop_box] * num_frames
+    return frames, coords, masks, mask_coords
+
+
+# ---------------------------------------------------------- stand-in models
+
+def stub_lipsync_models():
+    """Tiny torch modules with the MuseTalk UNet/VAE/PE interfaces."""
+    import torch
+    import torch.nn.functional as F
+
+    class StubUNet(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv2d(8, 4, 3, padding=1)
+            self.audio = torch.nn.Linear(384, 4)
+
+        @property
+        def dtype(self):
+            return self.conv.weight.dtype
+
+        def forward(self, latents, timesteps, encoder_hidden_states):
+            audio = self.audio(encoder_hidden_states.mean(dim=1))[:, :, None, None]
+            return SimpleNamespace(sample=self.conv(latents) + audio)
+
+    class StubDecoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv2d(4, 3, 3, padding=1)
+
+        @property
+        def dtype(self):
+            return self.conv.weight.dtype
+
+        def decode(self, latents):
+            return SimpleNamespace(sample=torch.tanh(F.interpolate(self.conv(latents), scale_factor=8)))
+
+    class StubVAE:
+        scaling_factor = 0.18215
+
+        def __init__(self):
+            self.vae = StubDecoder()
+            self.encoder = torch.nn.Conv2d(3, 4, 8, stride=8)
+
+        def preprocess_img(self, img, half_mask=False):
+            x = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)[None].float() / 127.5 - 1
+            if half_mask:
+                x[:, :, x.shape[2] // 2:] = 0
+            return x
+
+        def encode_latents(self, image):
+            return self.encoder(image) * self.scaling_factor
+
+    unet = SimpleNamespace(model=StubUNet().eval())
+    return unet, StubVAE(), torch.nn.Identity()
+
+
+class StubWhisper:
+    """faster-whisper stand-in: one segment per chunk after ``rtf`` x audio length."""
+
+    def __init__(self, rtf=0.02):
+        self.rtf = rtf
+
+    def transcribe(self, audio, **kwargs):
+        duration = len(audio) / SAMPLING_RATE
+        time.sleep(duration * self.rtf)
+        segment = SimpleNamespace(start=0.0, end=duration, text=f" {int(duration * 3)} words of speech")
+        return [segment], None
+
+
+class _StubLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible chat completions endpoint that echoes the prompt."""
+
+    latency_s = 0.05
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.latency_s)
+        text = body.get("messages", [{}])[-1].get("content", "")
+        payload = json.dumps({
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": f"[es] {text}"}}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_llm(latency_s):
+    handler = type("Handler", (_StubLLMHandler,), {"latency_s": latency_s})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+# ------------------------------------------------------------------- stages
+
+def bench_asr(ctx, workdir):
+    from model_registry import registry
+    from speech_to_text import transcribe_stream
+
+    if not ctx.real_models:
+        stub = StubWhisper(ctx.stub_rtf)
+        registry.register("faster_whisper", lambda device, dtype, **options: stub)
+    latencies = []
+    segments = []
+    last = time.perf_counter()
+    for segment in transcribe_stream(ctx.audio, num_workers=2):
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+        segments.append(segment)
+    ctx.segments = segments or ctx.segments
+    return {"items": len(segments), "item_latencies": latencies, "audio_s": len(ctx.audio) / SAMPLING_RATE}
+
+
+def bench_translate(ctx, workdir):
+    import llm
+    from together import Together
+
+    texts = [segment.text for segment in ctx.segments]
+    kwargs = {"cache": False}
+    if not ctx.real_models:
+        kwargs.update(base_url=ctx.llm_url, api_key="stub")
+    start_time = time.perf_counter()
+    translated = llm.translate_segments(texts, "English", "Spanish", **kwargs)
+    batch_s = time.perf_counter() - start_time
+
+    # The one-at-a-time path, for comparison
+    if not ctx.real_models:
+        llm.client = Together(base_url=ctx.llm_url, api_key="stub")
+    latencies = []
+    for text in texts[:4]:
+        start_time = time.perf_counter()
+        llm.translate_text_to_text(text, "English", "Spanish")
+        latencies.append(time.perf_counter() - start_time)
+    return {"items": len(translated), "item_latencies": latencies, "concurrent_batch_s": batch_s}
+
+
+def bench_tts(ctx, workdir):
+    from text_to_speech import assemble_track, fit_duration, synthesize_segments
+
+    if ctx.real_models:
+        track, sample_rate, _ = synthesize_segments(ctx.segments, ctx.reference_speaker,
+                                                    total_duration=len(ctx.audio) / SAMPLING_RATE)
+        return {"items": len(ctx.segments), "track_s": len(track) / sample_rate}
+
+    # Stand-in synthesis: speech of the wrong length, fitted to each segment's span
+    sample_rate = 22050
+    latencies = []
+    audios = []
+    for i, segment in enumerate(ctx.segments):
+        start_time = time.perf_counter()
+        raw = synthetic_speech(max(0.2, (segment.end - segment.start) * 1.3), seed=i)
+        audios.append(fit_duration(raw, int(round((segment.end - segment.start) * sample_rate))))
+        latencies.append(time.perf_counter() - start_time)
+    track = assemble_track(ctx.segments, audios, sample_rate, total_duration=len(ctx.audio) / SAMPLING_RATE)
+    return {"items": len(ctx.segments), "item_latencies": latencies, "track_s": len(track) / sample_rate}
+
+
+def bench_avatar_prep(ctx, workdir):
+    import avatar_cache
+    from avatar_prep import compute_bboxes, encode_latents, expand_bboxes
+
+    frames = list(ctx.frames)
+    # Landmarks whose bbox is the synthetic face box
+    x1, y1, x2, y2 = ctx.coords[0]
+    landmarks = np.zeros((68, 2), dtype=np.int32)
+    landmarks[:, 0] = np.linspace(x1, x2, 68)
+    landmarks[:, 1] = np.linspace(y1 + (y2 - y1) // 2, y2, 68)
+    detections = [(landmarks, ctx.coords[0])] * len(frames)
+
+    timings = {}
+    start_time = time.perf_counter()
+    coords = expand_bboxes(compute_bboxes(detections), frames, "v15", 10)
+    timings["bbox_s"] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    latents = encode_latents(ctx.vae, frames, coords, batch_size=16)
+    timings["latents_s"] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    avatar_cache.save(workdir, frames, coords, latents, ctx.masks, ctx.mask_coords)
+    timings["cache_save_s"] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    avatar_cache.load(workdir)
+    timings["cache_load_s"] = time.perf_counter() - start_time
+    # Masks need the face-parsing model and are not covered
+    return {"items": len(frames), **timings}
+
+
+def bench_unet_vae(ctx, workdir):
+    import torch
+    from batching import BatchScheduler
+    from device_io import LatentBank
+
+    num_frames = ctx.num_frames
+    whisper_chunks = torch.randn(num_frames, 50, 384)
+    bank = LatentBank(ctx.latents, "cpu", ctx.unet.model.dtype)
+    scheduler = BatchScheduler(ctx.unet, ctx.vae, ctx.pe, torch.device("cpu"), max_batch=ctx.batch_size)
+    frames_out = queue.Queue()
+    latencies = []
+    try:
+        for start in range(0, num_frames, ctx.batch_size):
+            count = min(ctx.batch_size, num_frames - start)
+            start_time = time.perf_counter()
+            scheduler.submit(whisper_chunks[start:start + count], bank.gather(start, count), frames_out).result()
+            latencies.append(time.perf_counter() - start_time)
+    finally:
+        scheduler.close()
+    return {"items": frames_out.qsize(), "item_latencies": latencies}
+
+
+def bench_blending(ctx, workdir):
+    import avatar_cache
+    from frame_blending import END_OF_STREAM, BlendingStage
+    from frame_sinks import FrameSink
+
+    class CountingSink(FrameSink):
+        def __init__(self):
+            self.frame_count = 0
+
+        def write(self, frame):
+            self.frame_count += 1
+
+    sink = CountingSink()
+    stage = BlendingStage(
+        avatar_cache.MirroredCycle(ctx.frames),
+        avatar_cache.MirroredCycle(ctx.coords),
+        avatar_cache.MirroredCycle(ctx.masks),
+        avatar_cache.MirroredCycle(ctx.mask_coords),
+        sink=sink,
+        num_workers=ctx.blend_workers,
+    )
+    res_frames = queue.Queue()
+    for res_frame in ctx.res_frames:
+        res_frames.put(res_frame)
+    res_frames.put(END_OF_STREAM)
+    stage.run(res_frames)
+    return {"items": sink.frame_count}
+
+
+def bench_encoding(ctx, workdir):
+    from frame_sinks import FfmpegPipeSink
+
+    if shutil.which("ffmpeg") is None:
+        raise MissingDependency("ffmpeg not found")
+    output_path = os.path.join(workdir, "out.mp4")
+    audio = ctx.audio[:int(ctx.num_frames / ctx.fps * SAMPLING_RATE)]
+    with FfmpegPipeSink(output_path, fps=ctx.fps, audio=audio, sample_rate=SAMPLING_RATE) as sink:
+        for i in range(ctx.num_frames):
+            sink.write(ctx.frames[i % len(ctx.frames)])
+    return {"items": ctx.num_frames, "video_bytes": os.path.getsize(output_path)}
+
+
+STAGES = {
+    "asr": bench_asr,
+    "translate": bench_translate,
+    "tts": bench_tts,
+    "avatar_prep": bench_avatar_prep,
+    "unet_vae": bench_unet_vae,
+    "blending": bench_blending,
+    "encoding": bench_encoding,
+}
+
+
+# --------------------------------------------------------------- reporting
+
+def compare(results, baseline, tolerance):
+    """
+    Compare median latencies with a previous run. A stage that was ok in the
+    baseline and now failed, was skipped or was not run also counts, with
+    None as its current p50 and change.
+    :return: List of (stage, baseline p50, current p50, relative change) over ``tolerance``.
+    """
+    regressions = []
+    for stage, previous in baseline.get("stages", {}).items():
+        report = results["stages"].get(stage, {"status": "missing", "reason": "not run"})
+        if previous.get("status") == "ok" and report["status"] != "ok":
+            print(f"{stage:12s} was ok in the baseline, now {report['status']}: {report['reason']} REGRESSION")
+            regressions.append((stage, previous["latency_s"]["p50"], None, None))
+    for stage, report in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage, {})
+        if report.get("status") != "ok" or previous.get("status") != "ok":
+            continue
+        old, new = previous["latency_s"]["p50"], report["latency_s"]["p50"]
+        change = (new - old) / old if old > 0 else 0.0
+        marker = "REGRESSION" if change > tolerance else ""
+        print(f"{stage:12s} p50 {old * 1000:9.1f}ms -> {new * 1000:9.1f}ms ({change:+.1%}) {marker}")
+        if change > tolerance:
+            regressions.append((stage, old, new, change))
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_context(args):
+    ctx = SimpleNamespace(**vars(args))
+    ctx.workdir = tempfile.mkdtemp(prefix="v2v-bench-")
+    ctx.audio = synthetic_speech(args.duration)
+    ctx.num_frames = int(args.duration * args.fps)
+    ctx.frames, ctx.coords, ctx.masks, ctx.mask_coords = synthetic_avatar(args.avatar_frames)
+    rng = np.random.default_rng(1)
+    ctx.res_frames = [rng.integers(0, 255, (256, 256, 3), dtype=np.uint8) for _ in range(ctx.num_frames)]
+    # Used by translate/tts when ASR is skipped or finds nothing
+    ctx.segments = [SimpleNamespace(start=s, end=min(s + 2.0, args.duration), text=f"sentence number {i}")
+                    for i, s in enumerate(np.arange(0, args.duration, 2.7))]
+    ctx.llm_server = None
+    if not args.real_models:
+        ctx.llm_server, ctx.llm_url = start_stub_llm(args.llm_latency)
+    try:
+        import torch
+        ctx.unet, ctx.vae, ctx.pe = stub_lipsync_models()
+        ctx.latents = torch.randn(args.avatar_frames, 1, 8, 32, 32)
+    except ImportError:
+        ctx.unet = ctx.vae = ctx.pe = ctx.latents = None
+    return ctx
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of synthetic audio/video")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--avatar_frames", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=20)
+    parser.add_argument("--blend_workers", type=int, default=4)
+    parser.add_argument("--stub_rtf", type=float, default=0.02, help="Stand-in ASR real-time factor")
+    parser.add_argument("--llm_latency", type=float, default=0.05, help="Stand-in LLM latency per request (s)")
+    parser.add_argument("--real_models", action="store_true", help="Use the real ASR/LLM/TTS models")
+    parser.add_argument("--reference_speaker", default="resources/sepideh_voice_test.mp3")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed p50 slowdown before flagging")
+    args = parser.parse_args()
+
+    ctx = build_context(args)
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "stages": {},
+    }
+    try:
+        for stage in args.stages:
+            print(f"benchmarking {stage}...")
+            report = run_stage(stage, STAGES[stage], ctx, args.repeat, args.warmup)
+            results["stages"][stage] = report
+            if report["status"] == "ok":
+                rate = report["items_per_s"]
+                print(f"  p50 {report['latency_s']['p50'] * 1000:.1f}ms, "
+                      f"{'-' if rate is None else f'{rate:.1f}'} items/s, "
+                      f"peak RSS {report['peak_rss_bytes'] / 2**20:.0f}MB")
+            else:
+                print(f"  {report['status']}: {report['reason']}")
+    finally:
+        if ctx.llm_server is not None:
+            ctx.llm_server.shutdown()
+        shutil.rmtree(ctx.workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+    failed = [stage for stage, report in results["stages"].items() if report["status"] == "failed"]
+    if regressions or failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import numpy as np
+import torch
+
+from metrics import metrics
+
+
+class LatentBank:
+    """
+    Avatar latents stacked into one (N, C, h, w) tensor, converted to the UNet
+    dtype once, and gathered by mirrored-cycle position with ``index_select``.
+
+    With ``resident`` the stack lives on the inference device, so a batch is a
+    single on-device gather; otherwise it stays in pinned host memory and each
+    gathered batch is copied asynchronously.
+    """
+
+    def __init__(self, latents, device, dtype, resident=True):
+        if isinstance(latents, torch.Tensor):
+            stack = latents.reshape(-1, *latents.shape[-3:])
+        else:
+            stack = torch.cat([latent.reshape(-1, *latent.shape[-3:]) for latent in latents])
+        stack = stack.to(dtype=dtype).contiguous()
+        self.device = torch.device(device)
+        if resident or self.device.type == "cpu":
+            self.stack = stack.to(self.device)
+        else:
+            self.stack = stack.pin_memory()
+        self.num_unique = len(stack)
+
+    def __len__(self):
+        """Length of the mirrored playback cycle."""
+        return 2 * self.num_unique
+
+    def indices(self, start, count):
+        """Unique-latent index of cycle positions ``start`` .. ``start + count - 1``."""
+        n = self.num_unique
+        positions = np.arange(start, start + count) % (2 * n)
+        return torch.from_numpy(np.where(positions < n, positions, 2 * n - 1 - positions))
+
+    @property
+    def resident(self):
+        """True when the stack lives on the inference device."""
+        return self.stack.device == self.device
+
+    def empty(self, count):
+        """
+        Buffer for ``gather(..., out=...)`` holding up to ``count`` latents, or
+        None when the stack is not resident (see ``gather``).
+        """
+        if not self.resident:
+            return None
+        return torch.empty((count,) + tuple(self.stack.shape[1:]), dtype=self.stack.dtype, device=self.stack.device)
+
+    def gather(self, start, count, out=None):
+        """
+        Latents for ``count`` consecutive cycle positions, on the inference device.
+        :param out: Optional buffer from ``empty`` reused across batches, on the
+            inference device. The gather is queued on the current CUDA stream, so it
+            is safe to pass once every earlier batch in it was queued on that stream.
+            Ignored for a host stack: the host would overwrite a pinned buffer while
+            the previous batch's copy to the device may still be reading it.
+        """
+        index = self.indices(start, count).to(self.stack.device, non_blocking=True)
+        if out is not None and self.resident:
+            out = out[:count]
+        else:
+            out = None
+        batch = torch.index_select(self.stack, 0, index, out=out)
+        if batch.device != self.device:
+            batch = batch.to(self.device, non_blocking=True)
+        return batch
+
+
+class PendingFrames:
+    """Decoded frames whose device-to-host copy may still be in flight."""
+
+    def __init__(self, host, event=None):
+        self.host = host
+        self.event = event
+
+    def result(self):
+        """(B, H, W, 3) uint8 BGR numpy array, once the copy has completed."""
+        if self.event is not None:
+            with metrics.span("decode_copy_wait"):
+                self.event.synchronize()
+        return self.host.numpy()
+
+
+@torch.no_grad()
+def decode_frames_async(vae, latents):
+    """
+    Same output as ``vae.decode_latents`` but the uint8 conversion and RGB->BGR
+    flip run on the device, and on CUDA the result is copied into pinned host
+    memory without blocking, so the next batch can be queued during the copy.
+    """
+    with metrics.span("vae_decode", batch=len(latents)):
+        latents = latents.to(dtype=vae.vae.dtype) / vae.scaling_factor
+        image = vae.vae.decode(latents).sample
+        image = ((image.float() / 2 + 0.5).clamp(0, 1) * 255).round().to(torch.uint8)
+        image = image.flip(1).permute(0, 2, 3, 1)
+    if not image.is_cuda:
+        return PendingFrames(image.contiguous())
+    host = torch.empty(image.shape, dtype=torch.uint8, pin_memory=True)
+    host.copy_(image, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record()
+    return PendingFrames(host, event)
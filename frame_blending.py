@@ -0,0 +1,166 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+# Put on the frame queue after the last generated frame
+END_OF_STREAM = None
+# Put on the frame queue instead of a generated face to output the original avatar frame
+ORIGINAL_FRAME = "original"
+
+
+def mask_alpha(mask, face_box, crop_box):
+    """
+    Blend weights of ``mask`` over ``face_box``, ready for ``blend_into``.
+    :return: (alpha, 255 - alpha), each an (h, w, 1) uint16 array.
+    """
+    x, y, x1, y1 = face_box
+    x_s, y_s = crop_box[0], crop_box[1]
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    alpha = mask[y - y_s:y1 - y_s, x - x_s:x1 - x_s, None].astype(np.uint16)
+    return alpha, 255 - alpha
+
+
+def blend_into(out, ori_frame, res_frame, face_box, mask, crop_box, alpha=None):
+    """
+    Vectorized equivalent of ``musetalk.utils.blending.get_image_blending`` that
+    writes into a preallocated ``out`` buffer.
+
+    The generated face only differs from the original inside ``face_box``, so
+    the mask-weighted blend is restricted to that region instead of pasting the
+    whole crop back through PIL.
+    :param out: (H, W, 3) uint8 buffer receiving the blended frame.
+    :param ori_frame: Original avatar frame, left untouched.
+    :param res_frame: Generated face, already resized to the face box.
+    :param face_box: (x1, y1, x2, y2) of the face in the frame.
+    :param mask: Blend mask covering ``crop_box``.
+    :param crop_box: (x1, y1, x2, y2) of the mask in the frame.
+    :param alpha: Precomputed ``mask_alpha(mask, face_box, crop_box)``, if any.
+    """
+    np.copyto(out, ori_frame)
+    x, y, x1, y1 = face_box
+    alpha, inv_alpha = alpha if alpha is not None else mask_alpha(mask, face_box, crop_box)
+    region = out[y:y1, x:x1]
+    blended = (res_frame.astype(np.uint16) * alpha + region.astype(np.uint16) * inv_alpha + 127) // 255
+    region[...] = blended.astype(np.uint8)
+    return out
+
+
+class BlendingStage:
+    """
+    Blend generated faces back into avatar frames on a thread pool.
+
+    Frames are read from a queue until ``END_OF_STREAM``, blended by ``num_workers``
+    threads (OpenCV and numpy release the GIL) into a ring of preallocated output
+    buffers, and written to ``sink`` in their original order. A buffer is reused
+    once the sink has consumed it, so sinks must not keep references to frames.
+    ``ORIGINAL_FRAME`` items hand the avatar frame to the sink as-is, without a
+    copy, and the optional per-frame ``weights`` scale the blend mask (fades
+    around skipped frames).
+
+    Frames of a static-head run share one mask object, so the blend weights
+    derived from it are kept in a small LRU keyed by mask and boxes and reused
+    for the whole run instead of being recomputed per frame.
+    """
+
+    alpha_cache_size = 8
+
+    def __init__(self, frames, coords, masks, mask_coords, sink=None, num_workers=4, weights=None):
+        self.frames = frames
+        self.coords = coords
+        self.masks = masks
+        self.mask_coords = mask_coords
+        self.sink = sink
+        self.num_workers = max(1, num_workers)
+        self.weights = weights
+        self.frame_count = 0
+        self._alpha_cache = collections.OrderedDict()
+        self._alpha_lock = threading.Lock()
+
+    def _alpha(self, mask, face_box, crop_box):
+        key = (id(mask), tuple(face_box), tuple(crop_box))
+        with self._alpha_lock:
+            entry = self._alpha_cache.get(key)
+            # The mask is kept in the entry, so its id cannot be reused by another one
+            if entry is not None and entry[0] is mask:
+                self._alpha_cache.move_to_end(key)
+                metrics.cache_lookup("blend_alpha", True)
+                return entry[1]
+        alpha = mask_alpha(mask, face_box, crop_box)
+        metrics.cache_lookup("blend_alpha", False)
+        with self._alpha_lock:
+            self._alpha_cache[key] = (mask, alpha)
+            while len(self._alpha_cache) > self.alpha_cache_size:
+                self._alpha_cache.popitem(last=False)
+        return alpha
+
+    def _blend(self, idx, res_frame, out):
+        with metrics.span("blend"):
+            return self._blend_frame(idx, res_frame, out)
+
+    def _blend_frame(self, idx, res_frame, out):
+        ori_frame = self.frames[idx]
+        if isinstance(res_frame, str) and res_frame == ORIGINAL_FRAME:
+            return ori_frame
+        x1, y1, x2, y2 = self.coords[idx]
+        try:
+            res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
+        except cv2.error:
+            # No face was detected in this frame; keep the original so audio stays in sync
+            return ori_frame
+        mask = self.masks[idx]
+        alpha, inv_alpha = self._alpha(mask, (x1, y1, x2, y2), self.mask_coords[idx])
+        if self.weights is not None and idx < len(self.weights) and self.weights[idx] < 1.0:
+            alpha = (alpha * float(self.weights[idx])).astype(np.uint16)
+            inv_alpha = 255 - alpha
+        return blend_into(out, ori_frame, res_frame, (x1, y1, x2, y2), mask, self.mask_coords[idx],
+                          alpha=(alpha, inv_alpha))
+
+    def run(self, res_frame_queue):
+        """Consume ``res_frame_queue`` until end of stream. Returns the number of frames written."""
+        num_buffers = 2 * self.num_workers
+        buffers = None
+        free = collections.deque()
+        pending = collections.deque()
+
+        def flush_one():
+            future, buffer = pending.popleft()
+            frame = future.result()
+            if self.sink is not None:
+                self.sink.write(frame)
+            free.append(buffer)
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            idx = 0
+            while True:
+                # Depth and wait show whether generation or blending is the bottleneck:
+                # a deep queue means blending lags, long waits mean generation does
+                metrics.set_gauge("frame_queue_depth", res_frame_queue.qsize())
+                wait_start = time.time()
+                res_frame = res_frame_queue.get()
+                metrics.observe("frame_queue_wait_seconds", time.time() - wait_start)
+                if res_frame is END_OF_STREAM:
+                    break
+                if buffers is None:
+                    buffers = [np.empty(self.frames[0].shape, dtype=np.uint8) for _ in range(num_buffers)]
+                    free.extend(buffers)
+                if not free:
+                    flush_one()
+                buffer = free.popleft()
+                pending.append((executor.submit(self._blend, idx, res_frame, buffer), buffer))
+                idx += 1
+            while pending:
+                flush_one()
+        self.frame_count = idx
+        elapsed = time.time() - start_time
+        metrics.increment("frames_total", idx)
+        if idx and elapsed > 0:
+            metrics.set_gauge("frames_per_second", idx / elapsed)
+        return idx
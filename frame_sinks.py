@@ -0,0 +1,232 @@
+import os
+import queue
+import subprocess
+import threading
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+from workspace import unique_tmp_path
+
+
+class FrameSink:
+    """
+    Destination for the blended BGR frames produced by ``Avatar.inference``.
+    Frames arrive in order through ``write``; ``close`` is called once after the last frame.
+    A frame is only valid during ``write``: its buffer is reused afterwards.
+    """
+
+    def write(self, frame):
+        raise NotImplementedError
+
+    def write_audio(self, samples):
+        """Audio arriving live alongside the frames; ignored by sinks that do not mux audio."""
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        """Called instead of ``close`` when the stream failed; must not publish partial output."""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class FfmpegPipeSink(FrameSink):
+    """
+    Encode frames through a single persistent ffmpeg process fed raw BGR over stdin.
+
+    ``audio`` may be a path ffmpeg can read or a mono float32 numpy array. Arrays
+    are streamed to the same ffmpeg process through a second pipe, so audio is
+    muxed in the same pass and nothing is written besides ``output_path``.
+    The encoder is started lazily on the first frame, once the frame size is known.
+    The video is encoded to a unique sibling file and renamed to ``output_path``
+    on a successful ``close``; ``abort`` (also called when a ``with`` block raises)
+    kills ffmpeg and deletes it, so concurrent or failed runs never leave a partial file there.
+
+    With ``live=True`` the output is written directly (it may be a URL such as
+    ``rtmp://...`` together with ``output_format="flv"``), the encoder is tuned for
+    latency, and audio is taken from ``write_audio`` as it arrives instead of ``audio``.
+    """
+
+    def __init__(self, output_path, fps=25, audio=None, sample_rate=16000, crf=18, live=False, output_format=None):
+        self.output_path = output_path
+        self.fps = fps
+        self.audio = audio
+        self.sample_rate = sample_rate
+        self.crf = crf
+        self.live = live
+        self.output_format = output_format
+        self.frame_count = 0
+        self._proc = None
+        self._audio_thread = None
+        self._audio_queue = queue.Queue() if live else None
+        self._tmp_path = None
+
+    def _start(self, height, width):
+        cmd = [
+            "ffmpeg", "-y", "-v", "warning",
+            "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}", "-r", str(self.fps),
+            "-i", "pipe:0",
+        ]
+        pass_fds = ()
+        audio_read_fd = audio_write_fd = None
+        has_audio = self.audio is not None or self.live
+        if isinstance(self.audio, str) and not self.live:
+            cmd += ["-i", self.audio]
+        elif has_audio:
+            audio_read_fd, audio_write_fd = os.pipe()
+            pass_fds = (audio_read_fd,)
+            cmd += ["-f", "f32le", "-ar", str(self.sample_rate), "-ac", "1", "-i", f"pipe:{audio_read_fd}"]
+        cmd += ["-vcodec", "libx264", "-vf", "format=yuv420p", "-crf", str(self.crf)]
+        if self.live:
+            cmd += ["-preset", "veryfast", "-tune", "zerolatency"]
+        if has_audio:
+            cmd += ["-acodec", "aac", "-shortest"]
+        if self.output_format is not None:
+            cmd += ["-f", self.output_format]
+        self._tmp_path = self.output_path if self.live else unique_tmp_path(self.output_path)
+        cmd += [self._tmp_path]
+
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, pass_fds=pass_fds)
+        if audio_write_fd is not None:
+            os.close(audio_read_fd)
+            if self.live:
+                chunks = iter(self._audio_queue.get, None)
+            else:
+                chunks = [np.ascontiguousarray(self.audio, dtype=np.float32).tobytes()]
+            self._audio_thread = threading.Thread(target=self._feed_audio, args=(audio_write_fd, chunks), daemon=True)
+            self._audio_thread.start()
+
+    @staticmethod
+    def _feed_audio(fd, chunks):
+        with os.fdopen(fd, "wb") as f:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    f.flush()
+            except BrokenPipeError:
+                pass
+
+    def write_audio(self, samples):
+        if self.live:
+            self._audio_queue.put(np.ascontiguousarray(samples, dtype=np.float32).tobytes())
+
+    def write(self, frame):
+        if self._proc is None:
+            self._start(frame.shape[0], frame.shape[1])
+        # Blocks while ffmpeg is behind, so this span measures encoder backpressure
+        with metrics.span("encode"):
+            self._proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.frame_count += 1
+
+    def close(self):
+        if self._proc is None:
+            return
+        self._proc.stdin.close()
+        if self._audio_queue is not None:
+            self._audio_queue.put(None)
+        if self._audio_thread is not None:
+            self._audio_thread.join()
+        with metrics.span("encode_finalize"):
+            returncode = self._proc.wait()
+        self._proc = None
+        if returncode != 0:
+            if not self.live and os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+            raise RuntimeError(f"ffmpeg exited with code {returncode} while writing {self.output_path}")
+        if not self.live:
+            os.replace(self._tmp_path, self.output_path)
+
+    def abort(self):
+        """Stop ffmpeg without finalizing the stream and delete the partial file."""
+        if self._proc is None:
+            return
+        self._proc.kill()
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        if self._audio_queue is not None:
+            self._audio_queue.put(None)
+        if self._audio_thread is not None:
+            self._audio_thread.join()
+        self._proc.wait()
+        self._proc = None
+        if not self.live and os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class ArraySink(FrameSink):
+    """
+    Collect frames in memory. With ``num_frames`` the output array is allocated
+    once on the first frame and filled in place.
+    """
+
+    def __init__(self, num_frames=None):
+        self.num_frames = num_frames
+        self.frame_count = 0
+        self._buffer = None
+        self._frames = []
+
+    def write(self, frame):
+        if self.num_frames is None:
+            self._frames.append(frame.copy())
+        else:
+            if self._buffer is None:
+                self._buffer = np.empty((self.num_frames,) + frame.shape, dtype=np.uint8)
+            self._buffer[self.frame_count] = frame
+        self.frame_count += 1
+
+    @property
+    def frames(self):
+        """(T, H, W, 3) uint8 array of the frames written so far."""
+        if self.num_frames is not None:
+            if self._buffer is None:
+                return np.empty((0,), dtype=np.uint8)
+            return self._buffer[:self.frame_count]
+        if not self._frames:
+            return np.empty((0,), dtype=np.uint8)
+        return np.stack(self._frames)
+
+
+class PngSink(FrameSink):
+    """Write every frame as ``%08d.png`` into ``directory``; meant for debugging."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.frame_count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, frame):
+        cv2.imwrite(f"{self.directory}/{str(self.frame_count).zfill(8)}.png", frame)
+        self.frame_count += 1
+
+
+class QueueSink(FrameSink):
+    """
+    Hand frames to a consumer thread through a bounded queue, e.g. to expose
+    live output as a generator. ``None`` is put after the last frame.
+    A full queue blocks the producer, so a slow consumer applies backpressure.
+    """
+
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.frame_count = 0
+
+    def write(self, frame):
+        self.queue.put(frame.copy())
+        self.frame_count += 1
+
+    def close(self):
+        self.queue.put(None)
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CHUNK_SIZE = 1 << 20
+
+
+def file_sha256(path):
+    """Hex sha256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_file_hash_memo = {}
+
+
+def cached_file_sha256(path):
+    """``file_sha256`` memoized on (path, size, mtime) so unchanged files are hashed once per process."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        _file_hash_memo[memo_key] = file_sha256(path)
+    return _file_hash_memo[memo_key]
+
+
+def path_sha256(path):
+    """Hash of a file, or of every file (names and contents) in a directory."""
+    if not os.path.isdir(path):
+        return file_sha256(path)
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if os.path.isfile(full):
+            h.update(name.encode())
+            h.update(file_sha256(full).encode())
+    return h.hexdigest()
+
+
+def array_sha256(array):
+    """Hash of a numpy array's dtype, shape and content."""
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha256()
+    h.update(str(array.dtype).encode())
+    h.update(str(array.shape).encode())
+    h.update(array.data)
+    return h.hexdigest()
+
+
+def params_hash(*parts):
+    """Short stable hash of JSON-serializable values, used to build cache keys."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
@@ -0,0 +1,222 @@
+import copy
+import json
+import os
+import platform
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from device_io import decode_frames_async
+from hashing import params_hash
+from workspace import unique_tmp_path
+
+BACKENDS = ("fp16", "bf16", "fp32", "int8", "torchscript")
+# Tried in this order by select_backend on CPU; fp32 is also the accuracy reference
+CPU_CANDIDATES = ("fp32", "bf16", "int8", "torchscript")
+DEFAULT_CHOICE_CACHE = "cache/inference_backend.json"
+
+_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def compute_dtype(backend):
+    """Dtype of the tensors fed to the UNet/VAE (and Whisper) under ``backend``."""
+    return _DTYPES.get(backend, torch.float32)
+
+
+def backend_for_dtype(dtype):
+    return {torch.float16: "fp16", torch.bfloat16: "bf16"}.get(dtype, "fp32")
+
+
+class _UNetForTrace(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.model(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+
+class _DecoderForTrace(torch.nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latents):
+        return self.vae.decode(latents, return_dict=False)[0]
+
+
+class TracedUNet(torch.nn.Module):
+    """TorchScript UNet with the diffusers call signature (``.sample`` output, ``dtype``)."""
+
+    def __init__(self, model, traced):
+        super().__init__()
+        self.model = model
+        self.traced = traced
+
+    @property
+    def dtype(self):
+        return self.model.dtype
+
+    @property
+    def config(self):
+        return self.model.config
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return SimpleNamespace(sample=self.traced(sample, timestep, encoder_hidden_states))
+
+
+class TracedDecoderVAE(torch.nn.Module):
+    """AutoencoderKL whose ``decode`` runs a TorchScript graph; ``encode`` stays eager."""
+
+    def __init__(self, vae, traced_decoder):
+        super().__init__()
+        self.vae = vae
+        self.traced_decoder = traced_decoder
+
+    @property
+    def dtype(self):
+        return self.vae.dtype
+
+    @property
+    def config(self):
+        return self.vae.config
+
+    def encode(self, *args, **kwargs):
+        return self.vae.encode(*args, **kwargs)
+
+    def decode(self, latents):
+        return SimpleNamespace(sample=self.traced_decoder(latents))
+
+
+def _example_inputs(unet, device, dtype, batch_size=2):
+    config = getattr(unet.model, "config", None)
+    in_channels = getattr(config, "in_channels", 8)
+    cross_dim = getattr(config, "cross_attention_dim", 384)
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn((batch_size, in_channels, 32, 32), generator=generator).to(device=device, dtype=dtype)
+    audio = torch.randn((batch_size, 50, cross_dim), generator=generator).to(device=device, dtype=dtype)
+    return latents, torch.tensor([0], device=device), audio
+
+
+def apply_backend(vae, unet, pe, backend, device):
+    """
+    Prepare freshly loaded MuseTalk models for ``backend``, in place.
+
+    fp16/bf16/fp32 cast the weights (eager); int8 additionally applies dynamic
+    int8 quantization to the UNet's linear layers (attention and projections; the
+    convolutions stay fp32); torchscript traces and freezes the UNet and the VAE
+    decoder for the given device.
+    :return: (vae, unet, pe)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {BACKENDS}")
+    dtype = compute_dtype(backend)
+    pe = pe.to(device=device, dtype=dtype)
+    vae.vae = vae.vae.to(device=device, dtype=dtype)
+    unet.model = unet.model.to(device=device, dtype=dtype)
+
+    if backend == "int8":
+        unet.model = torch.ao.quantization.quantize_dynamic(
+            unet.model.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    elif backend == "torchscript":
+        latents, timesteps, audio = _example_inputs(unet, device, dtype)
+        with torch.no_grad():
+            traced_unet = torch.jit.trace(_UNetForTrace(unet.model).eval(), (latents, timesteps, audio), check_trace=False)
+            decoder_input = torch.randn((2, 4, 32, 32)).to(device=device, dtype=dtype)
+            traced_decoder = torch.jit.trace(_DecoderForTrace(vae.vae).eval(), (decoder_input,), check_trace=False)
+        traced_unet = torch.jit.optimize_for_inference(torch.jit.freeze(traced_unet))
+        traced_decoder = torch.jit.optimize_for_inference(torch.jit.freeze(traced_decoder))
+        unet.model = TracedUNet(unet.model, traced_unet)
+        vae.vae = TracedDecoderVAE(vae.vae, traced_decoder)
+    return vae, unet, pe
+
+
+@torch.no_grad()
+def _run_frames(vae, unet, pe, inputs):
+    latents, timesteps, audio = inputs
+    dtype = unet.model.dtype
+    pred_latents = unet.model(latents.to(dtype=dtype), timesteps,
+                              encoder_hidden_states=pe(audio.to(dtype=dtype))).sample
+    return decode_frames_async(vae, pred_latents).result()
+
+
+def evaluate_backend(models, reference_frames, inputs, repeat=3):
+    """
+    Time one batch through PE + UNet + VAE decode and compare the frames with
+    the fp32 reference.
+    :return: Dict with seconds per batch, mean absolute error (0-255 levels) and PSNR.
+    """
+    vae, unet, pe = models
+    frames = _run_frames(vae, unet, pe, inputs)  # warmup (and trace compilation)
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        frames = _run_frames(vae, unet, pe, inputs)
+        timings.append(time.time() - start_time)
+    error = np.abs(frames.astype(np.float32) - reference_frames.astype(np.float32))
+    mse = float(np.mean(error ** 2))
+    return {
+        "seconds": float(np.median(timings)),
+        "mean_abs_error": float(np.mean(error)),
+        "psnr": float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse)),
+    }
+
+
+def select_backend(device, load_reference, candidates=CPU_CANDIDATES, batch_size=4, max_mean_abs_error=2.0,
+                   cache_path=DEFAULT_CHOICE_CACHE, cache_key=None):
+    """
+    Pick the inference backend for ``device``.
+
+    CUDA uses fp16. On CPU every candidate is built from a copy of the fp32
+    models, timed on one batch (checked at a batch size other than the one used
+    for tracing) and compared with fp32 output; the fastest candidate whose mean
+    absolute pixel error stays within ``max_mean_abs_error`` wins. The choice is
+    stored in ``cache_path`` under ``cache_key`` plus the CPU and torch version, so
+    it is measured once per machine and model.
+    :param load_reference: Callable returning fp32 (vae, unet, pe) on ``device``.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        return "fp16"
+
+    key = params_hash(cache_key, platform.processor(), platform.machine(), os.cpu_count(),
+                      torch.__version__, list(candidates), max_mean_abs_error)
+    choices = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            choices = json.load(f)
+        if key in choices:
+            return choices[key]["backend"]
+
+    reference = load_reference()
+    inputs = _example_inputs(reference[1], device, torch.float32, batch_size=batch_size)
+    reference_frames = _run_frames(*reference, inputs)
+    results = {}
+    for backend in candidates:
+        try:
+            models = reference if backend == "fp32" else apply_backend(*copy.deepcopy(reference), backend, device)
+            results[backend] = evaluate_backend(models, reference_frames, inputs)
+        except Exception as e:
+            results[backend] = {"error": f"{type(e).__name__}: {e}"}
+        print(f"backend {backend}: {results[backend]}")
+        models = None
+
+    accepted = [
+        backend for backend, result in results.items()
+        if "error" not in result and result["mean_abs_error"] <= max_mean_abs_error
+    ]
+    choice = min(accepted, key=lambda backend: results[backend]["seconds"]) if accepted else "fp32"
+    print(f"selected inference backend {choice} for {device}")
+
+    if cache_path is not None:
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        choices[key] = {"backend": choice, "results": results}
+        tmp_path = unique_tmp_path(cache_path)
+        with open(tmp_path, "w") as f:
+            json.dump(choices, f, indent=2)
+        os.replace(tmp_path, cache_path)
+    return choice
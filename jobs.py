@@ -0,0 +1,148 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+from workspace import new_request_id
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(RuntimeError):
+    """Raised by ``JobQueue.submit`` when ``max_queue`` jobs are already waiting."""
+
+
+class Job:
+    """
+    State of one submitted job. ``artifacts`` fills up while the job runs, so
+    readers can show partial results before it finishes.
+    """
+
+    def __init__(self, key):
+        self.id = new_request_id()
+        self.key = key
+        self.status = QUEUED
+        self.stage = None
+        self.fraction = 0.0
+        self.artifacts = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self._version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def _update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self._version += 1
+            self._changed.notify_all()
+
+    def report(self, stage, fraction, **artifacts):
+        """Progress callback handed to the job function."""
+        with self._changed:
+            self.stage = stage
+            self.fraction = fraction
+            self.artifacts.update(artifacts)
+            self._version += 1
+            self._changed.notify_all()
+
+    def updates(self, timeout=None):
+        """
+        Yield ``self`` every time the job changes, starting with its current
+        state, until it has finished.
+        :param timeout: Seconds to wait for a change before yielding anyway (heartbeat).
+        """
+        seen = -1
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._version != seen, timeout=timeout)
+                seen = self._version
+                finished = self.finished
+            yield self
+            if finished:
+                return
+
+    def wait(self, timeout=None):
+        with self._changed:
+            return self._changed.wait_for(lambda: self.finished, timeout=timeout)
+
+
+class JobQueue:
+    """
+    Run jobs on a bounded pool of worker threads.
+
+    At most ``max_workers`` jobs run at once and at most ``max_queue`` wait;
+    further submissions raise ``QueueFull``. Jobs are de-duplicated by key: a
+    submission whose key matches a queued, running or finished (and kept) job
+    returns that job instead of starting a new one. Failed jobs are not reused.
+    The last ``keep_finished`` finished jobs are kept for de-duplication.
+    """
+
+    def __init__(self, max_workers=1, max_queue=8, keep_finished=64):
+        self.max_queue = max_queue
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Queue ``fn(*args, progress=job.report, **kwargs)`` unless a job with ``key`` exists.
+        :param key: De-duplication key, e.g. a content hash of the inputs.
+        :return: The new or existing ``Job``.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status != FAILED:
+                self._jobs.move_to_end(key)
+                return job
+            waiting = sum(1 for other in self._jobs.values() if other.status == QUEUED)
+            if waiting >= self.max_queue:
+                raise QueueFull(f"{waiting} jobs are already waiting, try again later")
+            job = Job(key)
+            self._jobs[key] = job
+            self._jobs.move_to_end(key)
+            metrics.set_gauge("job_queue_depth", waiting + 1)
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        metrics.observe("job_queue_wait_seconds", time.time() - job.created)
+        job._update(status=RUNNING)
+        metrics.set_gauge("job_queue_depth", self.queued())
+        try:
+            result = fn(*args, progress=job.report, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            job._update(status=FAILED, error=str(e))
+        else:
+            job._update(status=DONE, result=result)
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = [key for key, job in self._jobs.items() if job.finished]
+            for key in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self._jobs[key]
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def queued(self):
+        """Number of jobs waiting for a worker."""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status == QUEUED)
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -1,24 +1,33 @@
 import argparse
 import os
 import numpy as np
-import cv2
 import torch
 import glob
 import pickle
 import sys
 from tqdm import tqdm
-import copy
 import json
 from transformers import WhisperModel
 
 from musetalk.utils.face_parsing import FaceParsing
-from musetalk.utils.utils import datagen
-from musetalk.utils.preprocessing import get_landmark_and_bbox, read_imgs
-from musetalk.utils.blending import get_image_prepare_material, get_image_blending
+from musetalk.utils.preprocessing import read_imgs
 from musetalk.utils.utils import load_all_model
 from musetalk.utils.audio_processor import AudioProcessor
 
-import shutil
+import avatar_cache
+from avatar_prep import prepare_avatar_material, stage_keys
+from device_io import LatentBank, decode_frames_async
+from frame_blending import END_OF_STREAM, ORIGINAL_FRAME, BlendingStage
+from frame_sinks import FfmpegPipeSink, PngSink, QueueSink
+from hashing import path_sha256
+from inference_backend import apply_backend, backend_for_dtype, compute_dtype, select_backend
+from media_io import read_audio
+from metrics import metrics
+from model_registry import registry
+from silence import generation_weights
+from whisper_features import WhisperChunkCache, WhisperFeatureStream, audio_key, whisper_chunk_cache
+from workspace import new_request_id, unique_tmp_path
+
 import threading
 import queue
 import time
@@ -38,7 +47,21 @@ defaults = {
     "batch_size": 20,
     "fps": 25,
     "skip_save_images": True,
-    "inference_config": "configs/inference/realtime.yaml"
+    "blend_workers": 4,
+    "prep_vae_batch_size": 16,
+    "prep_workers": 0,
+    "inference_config": "configs/inference/realtime.yaml",
+    "extra_margin": 10,
+    "parsing_mode": "jaw",
+    "static_bbox_tolerance": 2,
+    "static_mask_tolerance": 2.0,
+    "audio_padding_length_left": 2,
+    "audio_padding_length_right": 2,
+    "whisper_cache": True,
+    "silence_gate": False,
+    "latents_on_device": True,
+    "silence_threshold_db": -35.0,
+    "backend": "auto",
 }
 default_cfg = SimpleNamespace(**defaults)
 
@@ -50,36 +73,91 @@ def fast_check_ffmpeg():
     except:
         return False
 
-def video2imgs(vid_path, save_path, ext='.png', cut_frame=10000000):
-    cap = cv2.VideoCapture(vid_path)
-    count = 0
-    while True:
-        if count > cut_frame:
-            break
-        ret, frame = cap.read()
-        if ret:
-            cv2.imwrite(f"{save_path}/{count:08d}.png", frame)
-            count += 1
-        else:
-            break
+
+def ensure_ffmpeg(ffmpeg_path):
+    if not fast_check_ffmpeg():
+        print("Adding ffmpeg to PATH")
+        path_separator = ';' if sys.platform == 'win32' else ':'
+        os.environ["PATH"] = f"{ffmpeg_path}{path_separator}{os.environ['PATH']}"
+        if not fast_check_ffmpeg():
+            print("Warning: Unable to find ffmpeg, please ensure ffmpeg is properly installed")
+
+
+def avatar_base_path(avatar_id, version):
+    # 根据版本设置不同的基础路径
+    if version == "v15":
+        return f"./results/{version}/avatars/{avatar_id}"
+    return f"./results/avatars/{avatar_id}"
+
+
+def get_audio_feature(audio_processor, audio, weight_dtype=None):
+    """
+    Whisper input features for an audio file path or an in-memory waveform.
+    :param audio: Path to an audio file, or a mono 16 kHz float32 numpy array.
+    :return: (list of 30s feature chunks, number of samples)
+    """
+    if isinstance(audio, str):
+        return audio_processor.get_audio_feature(audio, weight_dtype=weight_dtype)
+    sampling_rate = 16000
+    segment_length = 30 * sampling_rate
+    features = []
+    for i in range(0, len(audio), segment_length):
+        audio_feature = audio_processor.feature_extractor(
+            audio[i:i + segment_length],
+            return_tensors="pt",
+            sampling_rate=sampling_rate
+        ).input_features
+        if weight_dtype is not None:
+            audio_feature = audio_feature.to(dtype=weight_dtype)
+        features.append(audio_feature)
+    return features, len(audio)
 
 
 def osmakedirs(path_list):
     for path in path_list:
         os.makedirs(path) if not os.path.exists(path) else None
 
+
+def _load_musetalk(device, dtype, unet_model_path, vae_type, unet_config, backend=None):
+    vae, unet, pe = load_all_model(
+        unet_model_path=unet_model_path,
+        vae_type=vae_type,
+        unet_config=unet_config,
+        device=device
+    )
+    return apply_backend(vae, unet, pe, backend or backend_for_dtype(dtype), device)
+
+
+def _load_whisper_encoder(device, dtype, whisper_dir):
+    whisper = WhisperModel.from_pretrained(whisper_dir)
+    whisper = whisper.to(device=device, dtype=dtype).eval()
+    whisper.requires_grad_(False)
+    return whisper
+
+
+def _load_audio_processor(device, dtype, whisper_dir):
+    return AudioProcessor(feature_extractor_path=whisper_dir)
+
+
+def _load_face_parsing(device, dtype, left_cheek_width=None, right_cheek_width=None):
+    if left_cheek_width is None and right_cheek_width is None:
+        return FaceParsing()
+    return FaceParsing(left_cheek_width=left_cheek_width, right_cheek_width=right_cheek_width)
+
+
+registry.register("musetalk", _load_musetalk)
+registry.register("whisper_encoder", _load_whisper_encoder)
+registry.register("audio_processor", _load_audio_processor)
+registry.register("face_parsing", _load_face_parsing)
+
+
 @torch.no_grad()
 class Avatar:
     def __init__(self, avatar_id, video_path, bbox_shift, batch_size, preparation, unet, vae, audio_processor, whisper, pe, fp, args=default_cfg):
         self.avatar_id = avatar_id
         self.video_path = video_path
         self.bbox_shift = bbox_shift
-        # 根据版本设置不同的基础路径
-        if args.version == "v15":
-            self.base_path = f"./results/{args.version}/avatars/{avatar_id}"
-        else:  # v1
-            self.base_path = f"./results/avatars/{avatar_id}"
-            
+        self.base_path = avatar_base_path(avatar_id, args.version)
         self.avatar_path = self.base_path
         self.full_imgs_path = f"{self.avatar_path}/full_imgs"
         self.coords_path = f"{self.avatar_path}/coords.pkl"
@@ -96,7 +174,6 @@ class Avatar:
         }
         self.preparation = preparation
         self.batch_size = batch_size
-        self.idx = 0
 
         self.args = args
         self.unet = unet
@@ -108,230 +185,512 @@ class Avatar:
         self.whisper = whisper
         self.pe = pe
         self.fp = fp
+        self.whisper_cache = whisper_chunk_cache if getattr(args, "whisper_cache", True) else None
 
         self.init()
 
     def init(self):
-        if self.preparation:
-            if os.path.exists(self.avatar_path):
-                response = input(f"{self.avatar_id} exists, Do you want to re-create it ? (y/n)")
-                if response.lower() == "y":
-                    shutil.rmtree(self.avatar_path)
-                    print("*********************************")
-                    print(f"  creating avator: {self.avatar_id}")
-                    print("*********************************")
-                    osmakedirs([self.avatar_path, self.full_imgs_path, self.video_out_path, self.mask_out_path])
-                    self.prepare_material()
-                else:
-                    self.input_latent_list_cycle = torch.load(self.latents_out_path)
-                    with open(self.coords_path, 'rb') as f:
-                        self.coord_list_cycle = pickle.load(f)
-                    input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-                    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                    self.frame_list_cycle = read_imgs(input_img_list)
-                    with open(self.mask_coords_path, 'rb') as f:
-                        self.mask_coords_list_cycle = pickle.load(f)
-                    input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-                    input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                    self.mask_list_cycle = read_imgs(input_mask_list)
-            else:
-                print("*********************************")
-                print(f"  creating avator: {self.avatar_id}")
-                print("*********************************")
-                osmakedirs([self.avatar_path, self.full_imgs_path, self.video_out_path, self.mask_out_path])
-                self.prepare_material()
-        else:
-            if not os.path.exists(self.avatar_path):
-                print(f"{self.avatar_id} does not exist, you should set preparation to True")
-                sys.exit()
-
-            with open(self.avatar_info_path, "r") as f:
-                avatar_info = json.load(f)
-
-            if avatar_info['bbox_shift'] != self.avatar_info['bbox_shift']:
-                response = input(f" 【bbox_shift】 is changed, you need to re-create it ! (c/continue)")
-                if response.lower() == "c":
-                    shutil.rmtree(self.avatar_path)
-                    print("*********************************")
-                    print(f"  creating avator: {self.avatar_id}")
-                    print("*********************************")
-                    osmakedirs([self.avatar_path, self.full_imgs_path, self.video_out_path, self.mask_out_path])
-                    self.prepare_material()
-                else:
-                    sys.exit()
-            else:
-                self.input_latent_list_cycle = torch.load(self.latents_out_path)
-                with open(self.coords_path, 'rb') as f:
-                    self.coord_list_cycle = pickle.load(f)
-                input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-                input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                self.frame_list_cycle = read_imgs(input_img_list)
-                with open(self.mask_coords_path, 'rb') as f:
-                    self.mask_coords_list_cycle = pickle.load(f)
-                input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-                input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-                self.mask_list_cycle = read_imgs(input_mask_list)
+        # Never prompts: existing material is reused when it matches the current
+        # video and parameters; otherwise it is rebuilt stage by stage, reusing
+        # every stage whose inputs did not change.
+        if not self.preparation and not os.path.exists(self.avatar_path):
+            raise FileNotFoundError(f"{self.avatar_id} does not exist, you should set preparation to True")
+        if self.material_is_current():
+            self.load_material()
+            return
+        if self.video_path is None:
+            raise ValueError(f"{self.avatar_id} is out of date and no video_path was given to rebuild it")
+        print("*********************************")
+        print(f"  creating avator: {self.avatar_id}")
+        print("*********************************")
+        osmakedirs([self.avatar_path, self.video_out_path])
+        self.prepare_material()
+
+    def read_avatar_info(self):
+        if not os.path.exists(self.avatar_info_path):
+            return None
+        with open(self.avatar_info_path, "r") as f:
+            return json.load(f)
+
+    def video_signature(self):
+        stat = os.stat(self.video_path)
+        return [stat.st_size, stat.st_mtime]
+
+    def video_hash(self):
+        # Rehashing a long video is slow; reuse the stored hash while size and mtime match
+        info = self.read_avatar_info()
+        if info is not None and info.get("video_signature") == self.video_signature() and "video_hash" in info:
+            return info["video_hash"]
+        return path_sha256(self.video_path)
+
+    def material_is_current(self):
+        info = self.read_avatar_info()
+        if info is None:
+            return False
+        if info.get("bbox_shift") != self.bbox_shift or info.get("version") != self.args.version:
+            return False
+        if "stage_keys" not in info or self.video_path is None:
+            # Avatar from before stage keys existed, or no source to compare against
+            return True
+        return info["stage_keys"] == stage_keys(self.video_hash(), self.bbox_shift, self.args)
+
+    def set_material(self, frame_list, coord_list, input_latent_list, mask_list, mask_coords_list):
+        """
+        Keep the N unique entries and expose the mirrored playback cycle as
+        index views over them, so the reversed half costs no memory.
+        """
+        self.frame_list = frame_list
+        self.coord_list = coord_list
+        self.input_latent_list = input_latent_list
+        self.mask_list = mask_list
+        self.mask_coords_list = mask_coords_list
+        self.frame_list_cycle = avatar_cache.MirroredCycle(frame_list)
+        self.coord_list_cycle = avatar_cache.MirroredCycle(coord_list)
+        self.input_latent_list_cycle = avatar_cache.MirroredCycle(input_latent_list)
+        # Stacked once in the UNet dtype, so batches are index gathers with no conversion
+        self.latent_bank = LatentBank(input_latent_list, self.device, self.weight_dtype,
+                                      resident=self.args.latents_on_device)
+        self.mask_list_cycle = avatar_cache.MirroredCycle(mask_list)
+        self.mask_coords_list_cycle = avatar_cache.MirroredCycle(mask_coords_list)
+
+    def load_material(self):
+        if avatar_cache.exists(self.avatar_path):
+            self.set_material(*avatar_cache.load(self.avatar_path))
+            return
+
+        # Avatar prepared before the npy cache existed: read the PNGs once and migrate
+        print(f"migrating avatar {self.avatar_id} to the npy cache format")
+        input_latent_list_cycle = torch.load(self.latents_out_path)
+        with open(self.coords_path, 'rb') as f:
+            coord_list_cycle = pickle.load(f)
+        input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
+        input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        # Legacy avatars stored the full mirrored cycle; only the first half is unique
+        frame_list = read_imgs(avatar_cache.first_half(input_img_list))
+        with open(self.mask_coords_path, 'rb') as f:
+            mask_coords_list_cycle = pickle.load(f)
+        input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
+        input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        mask_list = read_imgs(avatar_cache.first_half(input_mask_list))
+        self.set_material(
+            frame_list,
+            avatar_cache.first_half(coord_list_cycle),
+            avatar_cache.first_half(input_latent_list_cycle),
+            mask_list,
+            avatar_cache.first_half(mask_coords_list_cycle),
+        )
+        self.save_material()
+
+    def save_material(self):
+        avatar_cache.save(
+            self.avatar_path,
+            frames=self.frame_list,
+            coords=self.coord_list,
+            latents=self.input_latent_list,
+            masks=self.mask_list,
+            mask_coords=self.mask_coords_list,
+        )
 
     def prepare_material(self):
         print("preparing data materials ... ...")
-        with open(self.avatar_info_path, "w") as f:
+        video_hash = self.video_hash()
+
+        # Frames are decoded into memory, crops are VAE-encoded in batches and masks
+        # can be computed on a process pool (prep_workers); no PNGs are written.
+        # Playback runs forward then backward through the clip; the reversed half
+        # reuses the same frames, so everything is computed for the N unique ones.
+        # Each stage is cached under stages/ so interrupted runs resume.
+        stages_path = f"{self.avatar_path}/stages"
+        frame_list, coord_list, input_latent_list, mask_list, mask_coords_list, self.prepare_timings = prepare_avatar_material(
+            self.video_path, self.bbox_shift, self.vae, self.fp, self.args,
+            cache_dir=stages_path, video_hash=video_hash,
+        )
+        self.set_material(frame_list, coord_list, input_latent_list, mask_list, mask_coords_list)
+        self.save_material()
+
+        # Written last, so an avatar with info on disk is always complete
+        self.avatar_info.update({
+            "video_hash": video_hash,
+            "video_signature": self.video_signature(),
+            "stage_keys": stage_keys(video_hash, self.bbox_shift, self.args),
+        })
+        # Replaced atomically; other processes may be reading it in material_is_current
+        tmp_path = unique_tmp_path(self.avatar_info_path)
+        with open(tmp_path, "w") as f:
             json.dump(self.avatar_info, f)
-
-        if os.path.isfile(self.video_path):
-            video2imgs(self.video_path, self.full_imgs_path, ext='png')
-        else:
-            print(f"copy files in {self.video_path}")
-            files = os.listdir(self.video_path)
-            files.sort()
-            files = [file for file in files if file.split(".")[-1] == "png"]
-            for filename in files:
-                shutil.copyfile(f"{self.video_path}/{filename}", f"{self.full_imgs_path}/{filename}")
-        input_img_list = sorted(glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]')))
-
-        print("extracting landmarks...")
-        coord_list, frame_list = get_landmark_and_bbox(input_img_list, self.bbox_shift)
-        input_latent_list = []
-        idx = -1
-        # maker if the bbox is not sufficient
-        coord_placeholder = (0.0, 0.0, 0.0, 0.0)
-        for bbox, frame in zip(coord_list, frame_list):
-            idx = idx + 1
-            if bbox == coord_placeholder:
-                continue
-            x1, y1, x2, y2 = bbox
-            if self.args.version == "v15":
-                y2 = y2 + self.args.extra_margin
-                y2 = min(y2, frame.shape[0])
-                coord_list[idx] = [x1, y1, x2, y2]  # 更新coord_list中的bbox
-            crop_frame = frame[y1:y2, x1:x2]
-            resized_crop_frame = cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
-            latents = self.vae.get_latents_for_unet(resized_crop_frame)
-            input_latent_list.append(latents)
-
-        self.frame_list_cycle = frame_list + frame_list[::-1]
-        self.coord_list_cycle = coord_list + coord_list[::-1]
-        self.input_latent_list_cycle = input_latent_list + input_latent_list[::-1]
-        self.mask_coords_list_cycle = []
-        self.mask_list_cycle = []
-
-        for i, frame in enumerate(tqdm(self.frame_list_cycle)):
-            cv2.imwrite(f"{self.full_imgs_path}/{str(i).zfill(8)}.png", frame)
-
-            x1, y1, x2, y2 = self.coord_list_cycle[i]
-            if self.args.version == "v15":
-                mode = self.args.parsing_mode
+        os.replace(tmp_path, self.avatar_info_path)
+
+    @torch.no_grad()
+    def get_whisper_chunks(self, audio, fps):
+        """
+        Per-frame Whisper prompts for ``audio`` (path or 16 kHz array), served from
+        ``whisper_chunk_cache`` when the same audio was processed with the same settings.
+        """
+        def compute():
+            with metrics.span("whisper_features", streaming=False):
+                whisper_input_features, librosa_length = get_audio_feature(self.audio_processor, audio, weight_dtype=self.weight_dtype)
+                return self.audio_processor.get_whisper_chunk(
+                    whisper_input_features,
+                    self.device,
+                    self.weight_dtype,
+                    self.whisper,
+                    librosa_length,
+                    fps=fps,
+                    audio_padding_length_left=self.args.audio_padding_length_left,
+                    audio_padding_length_right=self.args.audio_padding_length_right,
+                )
+
+        if self.whisper_cache is None:
+            return compute()
+        key = WhisperChunkCache.key(
+            audio_key(audio),
+            self.args.whisper_dir,
+            self.weight_dtype,
+            fps,
+            self.args.audio_padding_length_left,
+            self.args.audio_padding_length_right,
+        )
+        return self.whisper_cache.get(key, compute, self.device)
+
+    @torch.no_grad()
+    def _launch_batch(self, whisper_batch, latent_batch):
+        """Queue PositionalEncoding, UNet and VAE decode for one batch; returns ``PendingFrames``."""
+        # On CUDA the spans time the host side; device time shows up in decode_copy_wait
+        with metrics.span("unet", batch=len(latent_batch)):
+            audio_feature_batch = self.pe(whisper_batch.to(self.device, non_blocking=True))
+            pred_latents = self.unet.model(latent_batch,
+                                    self.timesteps,
+                                    encoder_hidden_states=audio_feature_batch).sample
+        return decode_frames_async(self.vae, pred_latents)
+
+    @staticmethod
+    def _put_frames(pending, res_frame_queue):
+        for res_frame in pending.result():
+            res_frame_queue.put(res_frame)
+
+    def process_frames(self, res_frame_queue, video_len, sink=None, weights=None, errors=None, failed=None):
+        """
+        Blend generated frames into ``sink`` until ``END_OF_STREAM``; runs on its own thread.
+        :param errors: List receiving the exception if blending or the sink fails;
+            ``failed`` is set at the same time so generation can stop early.
+        """
+        stage = BlendingStage(
+            self.frame_list_cycle,
+            self.coord_list_cycle,
+            self.mask_list_cycle,
+            self.mask_coords_list_cycle,
+            sink=sink,
+            num_workers=self.args.blend_workers,
+            weights=weights,
+        )
+        try:
+            frame_count = stage.run(res_frame_queue)
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append(e)
+            failed.set()
+            return
+        if video_len is not None and frame_count != video_len:
+            print(f"Warning: expected {video_len} frames, blended {frame_count}")
+
+    def inference(self, audio_path, out_vid_name, fps, skip_save_images, sink=None, scheduler=None):
+        """
+        :param audio_path: Path to the driving audio, or a mono 16 kHz float32 numpy array.
+        :param sink: ``frame_sinks.FrameSink`` receiving every blended frame in order. The
+            caller owns it and closes it. When omitted, frames are encoded straight to
+            ``vid_output/{out_vid_name}.mp4`` with the audio muxed in, or written as PNGs
+            to ``tmp/<request id>/`` (kept for inspection, its path is printed) if no output
+            name is given, unless ``skip_save_images`` is set.
+        :param scheduler: Optional ``batching.BatchScheduler`` that runs UNet/VAE for this
+            request together with other concurrent requests.
+        """
+        owns_sink = False
+        output_path = None
+        if sink is None and skip_save_images is False:
+            if out_vid_name is not None:
+                os.makedirs(self.video_out_path, exist_ok=True)
+                output_path = os.path.join(self.video_out_path, out_vid_name + ".mp4")
+                sink = FfmpegPipeSink(output_path, fps=fps, audio=audio_path)
             else:
-                mode = "raw"
-            mask, crop_box = get_image_prepare_material(frame, [x1, y1, x2, y2], fp=self.fp, mode=mode)
-
-            cv2.imwrite(f"{self.mask_out_path}/{str(i).zfill(8)}.png", mask)
-            self.mask_coords_list_cycle += [crop_box]
-            self.mask_list_cycle.append(mask)
-
-        with open(self.mask_coords_path, 'wb') as f:
-            pickle.dump(self.mask_coords_list_cycle, f)
-
-        with open(self.coords_path, 'wb') as f:
-            pickle.dump(self.coord_list_cycle, f)
-
-        torch.save(self.input_latent_list_cycle, os.path.join(self.latents_out_path))
-
-    def process_frames(self, res_frame_queue, video_len, skip_save_images):
-        print(video_len)
-        while True:
-            if self.idx >= video_len - 1:
-                break
-            try:
-                start = time.time()
-                res_frame = res_frame_queue.get(block=True, timeout=1)
-            except queue.Empty:
-                continue
-
-            bbox = self.coord_list_cycle[self.idx % (len(self.coord_list_cycle))]
-            ori_frame = copy.deepcopy(self.frame_list_cycle[self.idx % (len(self.frame_list_cycle))])
-            x1, y1, x2, y2 = bbox
-            try:
-                res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
-            except:
-                continue
-            mask = self.mask_list_cycle[self.idx % (len(self.mask_list_cycle))]
-            mask_crop_box = self.mask_coords_list_cycle[self.idx % (len(self.mask_coords_list_cycle))]
-            combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
-
-            if skip_save_images is False:
-                cv2.imwrite(f"{self.avatar_path}/tmp/{str(self.idx).zfill(8)}.png", combine_frame)
-            self.idx = self.idx + 1
-
-    def inference(self, audio_path, out_vid_name, fps, skip_save_images):
-        os.makedirs(self.avatar_path + '/tmp', exist_ok=True)
+                # One directory per request so concurrent debug runs do not overwrite each other
+                output_path = f"{self.avatar_path}/tmp/{new_request_id()}"
+                sink = PngSink(output_path)
+            owns_sink = True
         print("start inference")
         ############################################## extract audio feature ##############################################
         start_time = time.time()
-        # Extract audio features
-        whisper_input_features, librosa_length = self.audio_processor.get_audio_feature(audio_path, weight_dtype=self.weight_dtype)
-        whisper_chunks = self.audio_processor.get_whisper_chunk(
-            whisper_input_features,
-            self.device,
-            self.weight_dtype,
-            self.whisper,
-            librosa_length,
-            fps=fps,
-            audio_padding_length_left=self.args.audio_padding_length_left,
-            audio_padding_length_right=self.args.audio_padding_length_right,
-        )
-        print(f"processing audio:{audio_path} costs {(time.time() - start_time) * 1000}ms")
+        audio = audio_path
+        if self.args.silence_gate and isinstance(audio_path, str):
+            # Decode once; the gate and the Whisper features both use the waveform
+            audio = read_audio(audio_path)
+        # Extract audio features, or reuse them if this audio was processed before
+        whisper_chunks = self.get_whisper_chunks(audio, fps)
+        audio_name = audio_path if isinstance(audio_path, str) else "in-memory audio"
+        print(f"processing audio:{audio_name} costs {(time.time() - start_time) * 1000}ms")
         ############################################## inference batch by batch ##############################################
         video_num = len(whisper_chunks)
+        weights = None
+        if self.args.silence_gate:
+            weights = generation_weights(audio, video_num, fps=fps, threshold_db=self.args.silence_threshold_db)
+            print(f"silence gate: skipping {int(np.sum(weights == 0))} of {video_num} frames")
         res_frame_queue = queue.Queue()
-        self.idx = 0
+        errors = []
+        failed = threading.Event()
         # Create a sub-thread and start it
-        process_thread = threading.Thread(target=self.process_frames, args=(res_frame_queue, video_num, skip_save_images))
+        process_thread = threading.Thread(target=self.process_frames,
+                                          args=(res_frame_queue, video_num, sink, weights, errors, failed))
         process_thread.start()
 
-        gen = datagen(whisper_chunks,
-                     self.input_latent_list_cycle,
-                     self.batch_size)
         start_time = time.time()
-        res_frame_list = []
 
-        for i, (whisper_batch, latent_batch) in enumerate(tqdm(gen, total=int(np.ceil(float(video_num) / self.batch_size)))):
-            audio_feature_batch = self.pe(whisper_batch.to(self.device))
-            latent_batch = latent_batch.to(device=self.device, dtype=self.unet.model.dtype)
-
-            pred_latents = self.unet.model(latent_batch,
-                                    self.timesteps,
-                                    encoder_hidden_states=audio_feature_batch).sample
-            pred_latents = pred_latents.to(device=self.device, dtype=self.vae.vae.dtype)
-            recon = self.vae.decode_latents(pred_latents)
-            for res_frame in recon:
-                res_frame_queue.put(res_frame)
-        # Close the queue and sub-thread after all tasks are completed
-        process_thread.join()
-
-        if self.args.skip_save_images is True:
+        try:
+            try:
+                if weights is not None:
+                    self._generate_gated(whisper_chunks, weights, res_frame_queue, scheduler, stop=failed)
+                else:
+                    self._generate(whisper_chunks, 0, res_frame_queue, scheduler, show_progress=True, stop=failed)
+            finally:
+                # Signal end of stream so the blending stage drains and exits
+                res_frame_queue.put(END_OF_STREAM)
+                process_thread.join()
+            if errors:
+                raise errors[0]
+        except BaseException:
+            if owns_sink:
+                sink.abort()
+            raise
+        if owns_sink:
+            sink.close()
+
+        if sink is None:
             print('Total process time of {} frames without saving images = {}s'.format(
                 video_num,
                 time.time() - start_time))
         else:
-            print('Total process time of {} frames including saving images = {}s'.format(
+            print('Total process time of {} frames including writing frames = {}s'.format(
                 video_num,
                 time.time() - start_time))
 
-        if out_vid_name is not None and self.args.skip_save_images is False:
-            # optional
-            cmd_img2video = f"ffmpeg -y -v warning -r {fps} -f image2 -i {self.avatar_path}/tmp/%08d.png -vcodec libx264 -vf format=yuv420p -crf 18 {self.avatar_path}/temp.mp4"
-            print(cmd_img2video)
-            os.system(cmd_img2video)
+        if output_path is not None:
+            print(f"result is save to {output_path}")
+        print("\n")
+
+    def inference_stream(self, audio_chunks, sink, fps=25, scheduler=None, context_s=1.0, cancel=None):
+        """
+        Live lipsync: generate frames while the audio is still arriving.
+
+        Whisper features are computed incrementally by ``WhisperFeatureStream``, and
+        every chunk's frames are generated and blended as soon as their right-hand
+        audio context is available. With 25 fps and the default padding, a frame
+        is ready ``audio_padding_length_right`` frames (plus one) after its audio, so
+        end-to-end latency is the chunk length + ~120 ms + one UNet/VAE batch.
+        :param audio_chunks: Iterable of mono 16 kHz float32 arrays, e.g. 100-200 ms
+            chunks read from a microphone or network stream.
+        :param sink: ``frame_sinks.FrameSink`` receiving frames in order, e.g. a live
+            ``FfmpegPipeSink`` or a ``QueueSink``; it also gets every chunk through
+            ``write_audio``. The caller owns and closes it.
+        :param scheduler: Optional ``batching.BatchScheduler`` shared with other requests.
+        :param context_s: Seconds of past audio each encoder pass sees.
+        :param cancel: Optional ``threading.Event``; once set, generation stops
+            before the next chunk or batch. It is also set if blending fails.
+        :return: Number of frames generated.
+        """
+        features = WhisperFeatureStream(
+            self.audio_processor,
+            self.whisper,
+            self.device,
+            self.weight_dtype,
+            fps=fps,
+            audio_padding_length_left=self.args.audio_padding_length_left,
+            audio_padding_length_right=self.args.audio_padding_length_right,
+            context_s=context_s,
+        )
+        res_frame_queue = queue.Queue()
+        errors = []
+        failed = cancel if cancel is not None else threading.Event()
+        process_thread = threading.Thread(target=self.process_frames,
+                                          args=(res_frame_queue, None, sink, None, errors, failed))
+        process_thread.start()
+
+        frame_count = 0
+        try:
+            for chunk in audio_chunks:
+                if failed.is_set():
+                    break
+                sink.write_audio(chunk)
+                frame_count = self._generate(features.push(chunk), frame_count, res_frame_queue, scheduler, stop=failed)
+            if not failed.is_set():
+                frame_count = self._generate(features.flush(), frame_count, res_frame_queue, scheduler, stop=failed)
+        finally:
+            res_frame_queue.put(END_OF_STREAM)
+            process_thread.join()
+        if errors:
+            raise errors[0]
+        return frame_count
+
+    def _generate(self, whisper_chunks, frame_offset, res_frame_queue, scheduler=None, show_progress=False, stop=None):
+        """
+        Run UNet/VAE for frames ``frame_offset`` onwards; returns the next frame index.
+        Stops before the next batch once the optional ``stop`` event is set.
+
+        Latents are gathered on the device from ``latent_bank``. Inline, each
+        batch's decoded frames are handed over only after the next batch has been
+        queued, so the device-to-host copy overlaps with compute.
+        """
+        if whisper_chunks is None:
+            return frame_offset
+        whisper_chunks = whisper_chunks.to(self.device, non_blocking=True)
+        num_frames = len(whisper_chunks)
+        starts = range(0, num_frames, self.batch_size)
+        if show_progress:
+            starts = tqdm(starts, total=int(np.ceil(float(num_frames) / self.batch_size)))
+
+        futures = []
+        pending = None
+        # Reused for every batch of this call when the latents are on the device: the
+        # gather and the UNet run in order on one stream. None for a host stack.
+        latent_buffer = self.latent_bank.empty(self.batch_size) if scheduler is None else None
+        for start in starts:
+            if stop is not None and stop.is_set():
+                break
+            whisper_batch = whisper_chunks[start:start + self.batch_size]
+            latent_batch = self.latent_bank.gather(frame_offset + start, len(whisper_batch), out=latent_buffer)
+            if scheduler is not None:
+                # The scheduler keeps a request's batches in order, so wait only at the end
+                futures.append(scheduler.submit(whisper_batch, latent_batch, res_frame_queue))
+                continue
+            launched = self._launch_batch(whisper_batch, latent_batch)
+            if pending is not None:
+                self._put_frames(pending, res_frame_queue)
+            pending = launched
+        if pending is not None:
+            self._put_frames(pending, res_frame_queue)
+        for future in futures:
+            future.result()
+        return frame_offset + num_frames
+
+    def _generate_gated(self, whisper_chunks, weights, res_frame_queue, scheduler=None, stop=None):
+        """
+        Generate only the frames with a non-zero weight; silent spans pass the
+        original avatar frames through without running UNet/VAE.
+        """
+        num_frames = len(whisper_chunks)
+        start = 0
+        while start < num_frames and not (stop is not None and stop.is_set()):
+            generate = weights[start] > 0
+            end = start
+            while end < num_frames and (weights[end] > 0) == generate:
+                end += 1
+            if generate:
+                self._generate(whisper_chunks[start:end], start, res_frame_queue, scheduler, stop=stop)
+            else:
+                for _ in range(start, end):
+                    res_frame_queue.put(ORIGINAL_FRAME)
+            start = end
+
+    def stream_frames(self, audio_chunks, fps=25, scheduler=None, max_buffered_frames=8):
+        """
+        Generator version of ``inference_stream``: yields blended BGR frames as
+        soon as they are ready. Generation pauses while ``max_buffered_frames``
+        frames wait to be consumed. Closing the generator early (e.g. the client
+        disconnected) cancels generation and releases the worker threads.
+        """
+        sink = QueueSink(maxsize=max_buffered_frames)
+        errors = []
+        cancel = threading.Event()
+
+        def produce():
+            try:
+                self.inference_stream(audio_chunks, sink, fps=fps, scheduler=scheduler, cancel=cancel)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                sink.close()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            for frame in iter(sink.queue.get, None):
+                yield frame
+        finally:
+            cancel.set()
+            # Keep taking frames so a producer blocked on the full queue can finish
+            while producer.is_alive():
+                try:
+                    sink.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+        if errors:
+            raise errors[0]
+
+
+def resolve_backend(args, device):
+    """
+    Inference backend for the UNet/VAE: ``args.backend`` unless it is "auto",
+    in which case fp16 on CUDA and on CPU the fastest backend that stays close
+    to fp32 output (measured once, then read from the choice cache).
+    """
+    backend = getattr(args, "backend", "auto")
+    if backend != "auto":
+        return backend
+    model_files = (args.unet_model_path, args.vae_type, args.unet_config)
+    return select_backend(
+        device,
+        lambda: _load_musetalk(device, torch.float32, *model_files, backend="fp32"),
+        cache_key=model_files,
+    )
 
-            output_vid = os.path.join(self.video_out_path, out_vid_name + ".mp4")  # on
-            cmd_combine_audio = f"ffmpeg -y -v warning -i {audio_path} -i {self.avatar_path}/temp.mp4 {output_vid}"
-            print(cmd_combine_audio)
-            os.system(cmd_combine_audio)
 
-            os.remove(f"{self.avatar_path}/temp.mp4")
-            shutil.rmtree(f"{self.avatar_path}/tmp")
-            print(f"result is save to {output_vid}")
-        print("\n")
+def load_models(args=default_cfg, weight_dtype=None):
+    """
+    Fetch every model the lipsync stage needs from the shared registry.
+    :param weight_dtype: Force eager inference in this dtype instead of ``args.backend``.
+    :return: SimpleNamespace with device, backend, vae, unet, pe, audio_processor, whisper and fp.
+    """
+    # Load device
+    device = torch.device(f"cuda:{args.gpu_id}" if torch.cuda.is_available() else "cpu")
+    backend = backend_for_dtype(weight_dtype) if weight_dtype is not None else resolve_backend(args, device)
+    weight_dtype = compute_dtype(backend)
+
+    # Load models (shared across calls through the registry)
+    vae, unet, pe = registry.get(
+        "musetalk",
+        device=device,
+        dtype=weight_dtype,
+        unet_model_path=args.unet_model_path,
+        vae_type=args.vae_type,
+        unet_config=args.unet_config,
+        backend=backend,
+    )
+
+    # Load Whisper
+    audio_processor = registry.get("audio_processor", whisper_dir=args.whisper_dir)
+    whisper = registry.get("whisper_encoder", device=device, dtype=weight_dtype, whisper_dir=args.whisper_dir)
+
+    # Face parser
+    if args.version == "v15":
+        fp = registry.get(
+            "face_parsing",
+            device=device,
+            left_cheek_width=args.left_cheek_width,
+            right_cheek_width=args.right_cheek_width
+        )
+    else:
+        fp = registry.get("face_parsing", device=device)
+
+    return SimpleNamespace(
+        device=device,
+        backend=backend,
+        vae=vae,
+        unet=unet,
+        pe=pe,
+        audio_processor=audio_processor,
+        whisper=whisper,
+        fp=fp,
+    )
+
 
 def lipsync(
     video_path: str,
@@ -360,13 +719,12 @@ def lipsync(
     right_cheek_width: int = 90,
     skip_save_images: bool = False,
     preparation: bool = True,
+    blend_workers: int = 4,
+    backend: str = "auto",
 ):
     
-    # Local args container
-    class Args:
-        pass
-
-    args = Args()
+    # Local args container; options without a parameter keep their defaults
+    args = SimpleNamespace(**defaults)
     args.version = version
     args.ffmpeg_path = ffmpeg_path
     args.gpu_id = gpu_id
@@ -389,57 +747,15 @@ def lipsync(
     args.left_cheek_width = left_cheek_width
     args.right_cheek_width = right_cheek_width
     args.skip_save_images = skip_save_images
+    args.blend_workers = blend_workers
+    args.backend = backend
 
     # Make it global for inner class access
     globals()["args"] = args
 
-    def fast_check_ffmpeg():
-        import subprocess
-        try:
-            subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True)
-            return True
-        except:
-            return False
-
     # Ensure FFmpeg
-    if not fast_check_ffmpeg():
-        print("Adding ffmpeg to PATH")
-        path_separator = ';' if sys.platform == 'win32' else ':'
-        os.environ["PATH"] = f"{args.ffmpeg_path}{path_separator}{os.environ['PATH']}"
-        if not fast_check_ffmpeg():
-            print("Warning: Unable to find ffmpeg, please ensure ffmpeg is properly installed")
-
-    # Load device
-    device = torch.device(f"cuda:{args.gpu_id}" if torch.cuda.is_available() else "cpu")
-
-    # Load models
-    vae, unet, pe = load_all_model(
-        unet_model_path=args.unet_model_path,
-        vae_type=args.vae_type,
-        unet_config=args.unet_config,
-        device=device
-    )
-    timesteps = torch.tensor([0], device=device)
-
-    pe = pe.half().to(device)
-    vae.vae = vae.vae.half().to(device)
-    unet.model = unet.model.half().to(device)
-
-    # Load Whisper
-    audio_processor = AudioProcessor(feature_extractor_path=args.whisper_dir)
-    weight_dtype = unet.model.dtype
-    whisper = WhisperModel.from_pretrained(args.whisper_dir)
-    whisper = whisper.to(device=device, dtype=weight_dtype).eval()
-    whisper.requires_grad_(False)
-
-    # Face parser
-    if args.version == "v15":
-        fp = FaceParsing(
-            left_cheek_width=args.left_cheek_width,
-            right_cheek_width=args.right_cheek_width
-        )
-    else:
-        fp = FaceParsing()
+    ensure_ffmpeg(args.ffmpeg_path)
+    models = load_models(args)
 
     # Create avatar and run inference
     avatar = Avatar(
@@ -448,12 +764,12 @@ def lipsync(
         bbox_shift=args.bbox_shift,
         batch_size=args.batch_size,
         preparation=preparation,
-        unet=unet,
-        vae=vae,
-        audio_processor=audio_processor,
-        whisper=whisper,
-        pe=pe,
-        fp=fp,
+        unet=models.unet,
+        vae=models.vae,
+        audio_processor=models.audio_processor,
+        whisper=models.whisper,
+        pe=models.pe,
+        fp=models.fp,
         args=args
     )
     avatar.inference(
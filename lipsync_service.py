@@ -0,0 +1,153 @@
+import os
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from batching import BatchScheduler
+from lipsync import Avatar, avatar_base_path, defaults, ensure_ffmpeg, load_models
+
+
+def avatar_nbytes(avatar):
+    """Approximate memory held by an avatar's prepared material."""
+    frames = avatar.frame_list
+    total = frames.nbytes if isinstance(frames, np.ndarray) else sum(frame.nbytes for frame in frames)
+    # Static-head runs share one mask object
+    total += sum(mask.nbytes for mask in {id(mask): mask for mask in avatar.mask_list}.values())
+    latents = avatar.input_latent_list
+    if isinstance(latents, torch.Tensor):
+        total += latents.numel() * latents.element_size()
+    else:
+        total += sum(latent.numel() * latent.element_size() for latent in latents)
+    return total
+
+
+class LipsyncService:
+    """
+    Long-lived lipsync server holding one copy of every model and a bounded pool
+    of prepared avatars.
+
+    UNet, VAE, PositionalEncoding, Whisper and FaceParsing come from the shared
+    model registry and are loaded once. Avatars are kept in LRU order and evicted
+    once there are more than ``max_avatars`` of them or their material exceeds
+    ``avatar_memory_budget_bytes``. ``inference`` may be called concurrently from
+    several threads, for the same or different avatar ids; their UNet/VAE work is
+    merged by a ``BatchScheduler`` (``max_batch`` frames, ``max_wait_ms`` latency).
+    Each request submits ``batch_size`` frames at a time, so ``max_batch`` defaults
+    to twice that: two full batches share one forward pass.
+    """
+
+    def __init__(self, max_avatars=8, avatar_memory_budget_bytes=None, max_batch=None, max_wait_ms=10, **options):
+        self.args = SimpleNamespace(**{**defaults, **options})
+        self.max_avatars = max_avatars
+        self.avatar_memory_budget_bytes = avatar_memory_budget_bytes
+        ensure_ffmpeg(self.args.ffmpeg_path)
+        self.models = load_models(self.args)
+        self.scheduler = BatchScheduler(
+            self.models.unet,
+            self.models.vae,
+            self.models.pe,
+            self.models.device,
+            max_batch=max_batch or 2 * self.args.batch_size,
+            max_wait_ms=max_wait_ms,
+        )
+
+        self._avatars = OrderedDict()
+        self._avatar_bytes = {}
+        self._lock = threading.Lock()
+        self._avatar_locks = {}
+
+    def get_avatar(self, avatar_id, video_path=None, bbox_shift=0):
+        """
+        Return a prepared avatar, loading it from disk or preparing it from
+        ``video_path`` on first use.
+        """
+        with self._lock:
+            if avatar_id in self._avatars:
+                self._avatars.move_to_end(avatar_id)
+                return self._avatars[avatar_id]
+            avatar_lock = self._avatar_locks.setdefault(avatar_id, threading.Lock())
+
+        # One thread prepares or loads a given avatar; others wait for it
+        with avatar_lock:
+            with self._lock:
+                if avatar_id in self._avatars:
+                    self._avatars.move_to_end(avatar_id)
+                    return self._avatars[avatar_id]
+
+            exists = os.path.exists(avatar_base_path(avatar_id, self.args.version))
+            if not exists and video_path is None:
+                raise ValueError(f"Avatar {avatar_id} is not prepared and no video_path was given")
+            avatar = Avatar(
+                avatar_id=avatar_id,
+                video_path=video_path,
+                bbox_shift=bbox_shift,
+                batch_size=self.args.batch_size,
+                preparation=not exists,
+                unet=self.models.unet,
+                vae=self.models.vae,
+                audio_processor=self.models.audio_processor,
+                whisper=self.models.whisper,
+                pe=self.models.pe,
+                fp=self.models.fp,
+                args=self.args,
+            )
+            with self._lock:
+                self._avatars[avatar_id] = avatar
+                self._avatar_bytes[avatar_id] = avatar_nbytes(avatar)
+                self._evict(keep=avatar_id)
+        return avatar
+
+    def inference(self, avatar_id, audio, sink=None, out_vid_name=None, fps=None, video_path=None, bbox_shift=0):
+        """
+        Lipsync ``audio`` (path or 16 kHz float32 array) onto ``avatar_id``.
+        Frames go to ``sink`` if given, otherwise to ``vid_output/{out_vid_name}.mp4``.
+        """
+        avatar = self.get_avatar(avatar_id, video_path=video_path, bbox_shift=bbox_shift)
+        avatar.inference(
+            audio,
+            out_vid_name=out_vid_name,
+            fps=fps or self.args.fps,
+            skip_save_images=sink is None and out_vid_name is None,
+            sink=sink,
+            scheduler=self.scheduler,
+        )
+
+    def inference_stream(self, avatar_id, audio_chunks, sink, fps=None, video_path=None, bbox_shift=0):
+        """
+        Live lipsync of ``audio_chunks`` (16 kHz float32 arrays as they arrive) onto
+        ``avatar_id``; see ``Avatar.inference_stream``.
+        """
+        avatar = self.get_avatar(avatar_id, video_path=video_path, bbox_shift=bbox_shift)
+        return avatar.inference_stream(audio_chunks, sink, fps=fps or self.args.fps, scheduler=self.scheduler)
+
+    def close(self):
+        self.scheduler.close()
+
+    def evict(self, avatar_id):
+        with self._lock:
+            self._avatars.pop(avatar_id, None)
+            self._avatar_bytes.pop(avatar_id, None)
+
+    def avatar_ids(self):
+        """Pooled avatar ids, least recently used first."""
+        with self._lock:
+            return list(self._avatars.keys())
+
+    def _evict(self, keep=None):
+        def over_budget():
+            if len(self._avatars) > self.max_avatars:
+                return True
+            if self.avatar_memory_budget_bytes is None:
+                return False
+            return sum(self._avatar_bytes.values()) > self.avatar_memory_budget_bytes
+
+        while over_budget():
+            victim = next((avatar_id for avatar_id in self._avatars if avatar_id != keep), None)
+            if victim is None:
+                break
+            print(f"evicting avatar {victim}")
+            del self._avatars[victim]
+            del self._avatar_bytes[victim]
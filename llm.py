@@ -1,25 +1,196 @@
+import asyncio
+import hashlib
+import json
 import os
+import sqlite3
+import threading
 os.environ["TOGETHER_API_KEY"] = "YOUR_KEY_HERE"
 
-from together import Together
+from together import AsyncTogether, Together
+
+from metrics import metrics
 client = Together()
 model_name = "google/gemma-2b-it"
 
+default_cache_path = os.environ.get("TRANSLATION_CACHE_PATH", "cache/translations.sqlite3")
+
+
+def _messages(source_text, source_language, target_language):
+    return [
+        {
+        "role": "system",
+        "content": f"You are an expert in translation from {source_language} to {target_language}. You are very precise and accurate. \
+            Only output the translation, and say nothing more."
+        },
+        {
+        "role": "user",
+        "content": source_text
+        }
+    ]
+
+
 def translate_text_to_text(source_text, source_language, target_language):
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[
-            {
-            "role": "system",
-            "content": f"You are an expert in translation from {source_language} to {target_language}. You are very precise and accurate. \
-                Only output the translation, and say nothing more."
-            },
-            {
-            "role": "user",
-            "content": source_text
-            }
-        ],
-        stream=False,
-        )
+    with metrics.span("translate"):
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=_messages(source_text, source_language, target_language),
+            stream=False,
+            )
 
     return response.choices[0].message.content
+
+
+class TranslationCache:
+    """
+    Persistent translation cache in a SQLite file, keyed by
+    (text, source language, target language, model). Safe to share between threads.
+    """
+
+    def __init__(self, path=default_cache_path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text, source_language, target_language, model):
+        payload = json.dumps([text, source_language, target_language, model])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, text, source_language, target_language, model):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT translation FROM translations WHERE key = ?",
+                (self.key(text, source_language, target_language, model),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, text, source_language, target_language, model, translation):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO translations (key, translation) VALUES (?, ?)",
+                (self.key(text, source_language, target_language, model), translation),
+            )
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+_shared_lock = threading.Lock()
+_shared_caches = {}
+
+
+def shared_translation_cache(path=default_cache_path):
+    """Process-wide ``TranslationCache`` for ``path``, opened on first use."""
+    with _shared_lock:
+        if path not in _shared_caches:
+            _shared_caches[path] = TranslationCache(path)
+        return _shared_caches[path]
+
+
+def _async_client(base_url=None, api_key=None):
+    """
+    New ``AsyncTogether`` client. Its pooled connections belong to the event loop
+    that opens them, so use one per loop (``async with``) rather than one per process.
+    """
+    client_kwargs = {}
+    if base_url is not None:
+        client_kwargs["base_url"] = base_url
+    if api_key is not None:
+        client_kwargs["api_key"] = api_key
+    return AsyncTogether(**client_kwargs)
+
+
+async def _translate_one(async_client, semaphore, text, source_language, target_language, model, retries):
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                with metrics.span("translate_request", attempt=attempt):
+                    response = await async_client.chat.completions.create(
+                        model=model,
+                        messages=_messages(text, source_language, target_language),
+                        stream=False,
+                    )
+                return response.choices[0].message.content.strip()
+            except Exception as e:
+                metrics.increment("translate_request_errors_total")
+                if attempt == retries:
+                    raise
+                delay = 0.5 * 2 ** attempt
+                print(f"translation request failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+
+async def translate_segments_async(
+    segments,
+    source_language,
+    target_language,
+    model=model_name,
+    max_concurrency=8,
+    cache=None,
+    base_url=None,
+    api_key=None,
+    retries=3,
+):
+    """
+    Translate many transcript segments concurrently.
+
+    Identical texts are sent once, cached translations are not sent at all, and
+    the rest go out concurrently (at most ``max_concurrency`` in flight) over one
+    async client whose connections are reused for the whole call.
+    :param segments: Strings or objects with a ``text`` field and ``_replace``
+        (e.g. ``speech_to_text.TranscriptSegment``).
+    :param cache: ``TranslationCache``, by default the shared one for ``default_cache_path``;
+        pass ``False`` to disable caching.
+    :param base_url: OpenAI-compatible endpoint, e.g. a local stub server for tests.
+    :return: List matching ``segments`` with the text translated.
+    """
+    if cache is None:
+        cache = shared_translation_cache()
+    texts = [segment if isinstance(segment, str) else segment.text for segment in segments]
+
+    translations = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        cached = cache.get(text, source_language, target_language, model) if cache else None
+        if cache:
+            metrics.cache_lookup("translation", cached is not None)
+        if cached is not None:
+            translations[text] = cached
+        elif text.strip():
+            missing.append(text)
+        else:
+            translations[text] = text
+
+    if missing:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async with _async_client(base_url, api_key) as async_client:
+            results = await asyncio.gather(*[
+                _translate_one(async_client, semaphore, text, source_language, target_language, model, retries)
+                for text in missing
+            ], return_exceptions=True)
+        # Cache every translation that succeeded before reporting a failure, so a retry only resends the rest
+        errors = []
+        for text, translation in zip(missing, results):
+            if isinstance(translation, BaseException):
+                errors.append(translation)
+                continue
+            translations[text] = translation
+            if cache:
+                cache.put(text, source_language, target_language, model, translation)
+        if errors:
+            raise errors[0]
+
+    return [
+        translations[segment] if isinstance(segment, str) else segment._replace(text=translations[segment.text])
+        for segment in segments
+    ]
+
+
+def translate_segments(segments, source_language, target_language, **kwargs):
+    """Blocking wrapper around ``translate_segments_async``."""
+    with metrics.span("translate_batch", segments=len(segments)):
+        return asyncio.run(translate_segments_async(segments, source_language, target_language, **kwargs))
@@ -0,0 +1,20 @@
+import subprocess
+
+import numpy as np
+
+
+def read_audio(path, sample_rate=16000):
+    """
+    Decode the audio track of an audio or video file straight into memory.
+    :param path: Path to any file ffmpeg can read.
+    :param sample_rate: Output sample rate.
+    :return: Mono float32 numpy array.
+    """
+    cmd = [
+        "ffmpeg", "-v", "error", "-nostdin",
+        "-i", path,
+        "-vn", "-ac", "1", "-ar", str(sample_rate),
+        "-f", "f32le", "pipe:1",
+    ]
+    result = subprocess.run(cmd, capture_output=True, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32).copy()
@@ -0,0 +1,299 @@
+"""
+Lightweight tracing and metrics shared by every pipeline stage.
+
+Code records spans (``with metrics.span("unet", batch=20): ...``), counters,
+gauges and observations on the process-wide ``metrics`` object. Aggregates
+are always kept in memory (count/sum/max per name and labels, cheap enough
+for per-frame use), and every event is also forwarded to the registered
+sinks: ``LogSink`` prints spans, ``PrometheusSink`` renders the text exposition
+format, and ``OpenTelemetrySink`` forwards to the OpenTelemetry API if installed.
+"""
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Span:
+    __slots__ = ("name", "attributes", "parent", "start", "end", "thread", "sink_state")
+
+    def __init__(self, name, attributes, parent):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.start = time.time()
+        self.end = None
+        self.thread = threading.current_thread().name
+        # Per-sink data kept between on_span_start and on_span (e.g. the OpenTelemetry span)
+        self.sink_state = {}
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+class Metrics:
+    """
+    Counters, gauges, observation summaries and spans. Thread-safe.
+    Span durations are also observed as ``<name>_seconds``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._summaries = {}
+        self._sinks = []
+
+    def add_sink(self, sink):
+        with self._lock:
+            self._sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        with self._lock:
+            self._sinks.remove(sink)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] += value
+            sinks = list(self._sinks)
+        for sink in sinks:
+            sink.on_counter(name, value, labels)
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+            sinks = list(self._sinks)
+        for sink in sinks:
+            sink.on_gauge(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            count, total, maximum = self._summaries.get(key, (0, 0.0, 0.0))
+            self._summaries[key] = (count + 1, total + value, max(maximum, value))
+            sinks = list(self._sinks)
+        for sink in sinks:
+            sink.on_observation(name, value, labels)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time a block. Nested spans record their parent, also across ``contextvars`` copies."""
+        span = Span(name, attributes, _current_span.get())
+        token = _current_span.set(span)
+        with self._lock:
+            sinks = list(self._sinks)
+        for sink in sinks:
+            sink.on_span_start(span)
+        try:
+            yield span
+        finally:
+            span.end = time.time()
+            _current_span.reset(token)
+            self.observe(f"{name}_seconds", span.duration)
+            with self._lock:
+                sinks = list(self._sinks)
+            for sink in sinks:
+                sink.on_span(span)
+
+    def cache_lookup(self, cache, hit):
+        """Count a cache hit or miss; the hit rate is ``result="hit"`` over all requests."""
+        self.increment("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    def snapshot(self):
+        """
+        Current aggregates.
+        :return: Dict with ``counters``, ``gauges`` and ``summaries`` keyed by
+            (name, ((label, value), ...)); summaries are (count, sum, max).
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": dict(self._summaries),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+
+class MetricsSink:
+    """Receives every event as it is recorded. Implementations must be thread-safe and fast."""
+
+    def on_span_start(self, span):
+        pass
+
+    def on_span(self, span):
+        pass
+
+    def on_counter(self, name, value, labels):
+        pass
+
+    def on_gauge(self, name, value, labels):
+        pass
+
+    def on_observation(self, name, value, labels):
+        pass
+
+
+class LogSink(MetricsSink):
+    """Print spans longer than ``min_duration_s`` (and, optionally, every gauge)."""
+
+    def __init__(self, min_duration_s=0.0, gauges=False, log=print):
+        self.min_duration_s = min_duration_s
+        self.gauges = gauges
+        self.log = log
+
+    def on_span(self, span):
+        if span.duration >= self.min_duration_s:
+            attributes = " ".join(f"{k}={v}" for k, v in span.attributes.items())
+            parent = f" parent={span.parent.name}" if span.parent is not None else ""
+            self.log(f"[span] {span.name} {span.duration * 1000:.1f}ms thread={span.thread}{parent} {attributes}".rstrip())
+
+    def on_gauge(self, name, value, labels):
+        if self.gauges:
+            self.log(f"[gauge] {name}{_format_labels(_label_key(labels))} {value}")
+
+
+def _format_labels(label_key):
+    if not label_key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in label_key) + "}"
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Render ``metrics`` in the Prometheus text exposition format. Counters and
+    gauges are exported as-is and observations as summaries (``_count``/``_sum``)
+    plus a ``_max`` gauge. ``serve(port)`` exposes ``/metrics`` over HTTP.
+    """
+
+    def __init__(self, source=None, prefix="v2v_"):
+        self.source = source
+        self.prefix = prefix
+        self._server = None
+
+    def render(self):
+        snapshot = (self.source or metrics).snapshot()
+        lines = []
+        typed = set()
+
+        def emit(name, kind, label_key, value):
+            name = self.prefix + name
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(label_key)} {value}")
+
+        for (name, label_key), value in sorted(snapshot["counters"].items()):
+            emit(name, "counter", label_key, value)
+        for (name, label_key), value in sorted(snapshot["gauges"].items()):
+            emit(name, "gauge", label_key, value)
+        for (name, label_key), (count, total, maximum) in sorted(snapshot["summaries"].items()):
+            emit(f"{name}_count", "counter", label_key, count)
+            emit(f"{name}_sum", "counter", label_key, total)
+            emit(f"{name}_max", "gauge", label_key, maximum)
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="0.0.0.0"):
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+class OpenTelemetrySink(MetricsSink):
+    """
+    Forward spans and counters to the OpenTelemetry API. Configure the SDK
+    and exporter (OTLP, console...) as usual; without an SDK the calls are no-ops.
+    """
+
+    def __init__(self, service_name="video-2-video-translator"):
+        try:
+            from opentelemetry import metrics as otel_metrics
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError("OpenTelemetrySink needs the opentelemetry-api package") from e
+        self._trace = trace
+        self._tracer = trace.get_tracer(service_name)
+        self._meter = otel_metrics.get_meter(service_name)
+        self._instruments = {}
+        self._gauge_values = {}
+        self._lock = threading.Lock()
+
+    def _instrument(self, kind, name):
+        with self._lock:
+            if (kind, name) not in self._instruments:
+                factory = {
+                    "counter": self._meter.create_counter,
+                    "histogram": self._meter.create_histogram,
+                    "gauge": self._meter.create_up_down_counter,
+                }[kind]
+                self._instruments[(kind, name)] = factory(name)
+            return self._instruments[(kind, name)]
+
+    def on_span_start(self, span):
+        # Parent the OpenTelemetry span on the one created for span.parent, so traces keep their nesting
+        parent = span.parent.sink_state.get(self) if span.parent is not None else None
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        span.sink_state[self] = self._tracer.start_span(
+            span.name, context=context, start_time=int(span.start * 1e9),
+            attributes={k: str(v) for k, v in span.attributes.items()},
+        )
+
+    def on_span(self, span):
+        otel_span = span.sink_state.pop(self, None)
+        if otel_span is not None:
+            otel_span.end(end_time=int(span.end * 1e9))
+
+    def on_counter(self, name, value, labels):
+        self._instrument("counter", name).add(value, {k: str(v) for k, v in labels.items()})
+
+    def on_gauge(self, name, value, labels):
+        # An up-down counter moved by the difference always holds the last value
+        key = (name, _label_key(labels))
+        with self._lock:
+            delta = value - self._gauge_values.get(key, 0.0)
+            self._gauge_values[key] = value
+        self._instrument("gauge", name).add(delta, {k: str(v) for k, v in labels.items()})
+
+    def on_observation(self, name, value, labels):
+        self._instrument("histogram", name).record(value, {k: str(v) for k, v in labels.items()})
+
+
+metrics = Metrics()
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+from metrics import metrics
+
+
+def estimate_nbytes(obj):
+    """
+    Best-effort estimate of the memory held by a loaded model.
+    Walks torch modules (parameters and buffers), tuples/lists of them, and one
+    level of attributes for wrapper objects such as MuseTalk's VAE/UNet holders.
+    :param obj: Loaded model object.
+    :return: Estimated size in bytes (0 when nothing measurable is found).
+    """
+    if isinstance(obj, torch.nn.Module):
+        total = sum(p.numel() * p.element_size() for p in obj.parameters())
+        total += sum(b.numel() * b.element_size() for b in obj.buffers())
+        return total
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_nbytes(o) for o in obj)
+    total = 0
+    for value in getattr(obj, "__dict__", {}).values():
+        if isinstance(value, (torch.nn.Module, torch.Tensor)):
+            total += estimate_nbytes(value)
+    return total
+
+
+def _dtype_name(dtype):
+    if dtype is None:
+        return None
+    return str(dtype).replace("torch.", "")
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models keyed by (model, device, dtype).
+
+    Loaders are registered once by name and called lazily the first time a
+    (name, device, dtype, options) combination is requested. Loaded models are
+    kept in LRU order and evicted when the estimated total size exceeds
+    ``memory_budget_bytes``.
+    """
+
+    def __init__(self, memory_budget_bytes=None):
+        self.memory_budget_bytes = memory_budget_bytes
+        self._loaders = {}
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+
+    def register(self, name, loader, warmup=None):
+        """
+        Register a loader for a model name.
+        :param name: Model name used in lookups.
+        :param loader: Callable ``loader(device, dtype, **options)`` returning the model.
+        :param warmup: Optional callable ``warmup(model)`` run once after loading.
+        """
+        with self._lock:
+            self._loaders[name] = (loader, warmup)
+
+    def _key(self, name, device, dtype, options):
+        return (name, str(device), _dtype_name(dtype), tuple(sorted(options.items())))
+
+    def get(self, name, device="cpu", dtype=None, **options):
+        """
+        Return the model for (name, device, dtype, options), loading it on first use.
+        """
+        key = self._key(name, device, dtype, options)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]["model"]
+            if name not in self._loaders:
+                raise KeyError(f"No loader registered for model '{name}'")
+            loader, warmup = self._loaders[name]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Load outside the registry lock so other models stay available, but make
+        # sure concurrent requests for the same key only load it once.
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]["model"]
+            start_time = time.time()
+            with metrics.span("model_load", model=name, device=device):
+                model = loader(device, dtype, **options)
+                if warmup is not None:
+                    warmup(model)
+            nbytes = estimate_nbytes(model)
+            print(f"loaded model {name} on {device} ({_dtype_name(dtype)}) in {(time.time() - start_time) * 1000:.0f}ms, ~{nbytes / 2**20:.0f}MB")
+            with self._lock:
+                self._entries[key] = {"model": model, "nbytes": nbytes}
+                self._evict(keep=key)
+        return model
+
+    def warmup(self, name, device="cpu", dtype=None, **options):
+        """Load a model ahead of the first request."""
+        self.get(name, device=device, dtype=dtype, **options)
+
+    def unload(self, name, device=None, dtype=None):
+        """
+        Drop loaded models matching ``name`` (and ``device``/``dtype`` if given).
+        :return: Number of entries removed.
+        """
+        with self._lock:
+            keys = [
+                key for key in self._entries
+                if key[0] == name
+                and (device is None or key[1] == str(device))
+                and (dtype is None or key[2] == _dtype_name(dtype))
+            ]
+            for key in keys:
+                del self._entries[key]
+        if keys:
+            self._release_memory()
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._release_memory()
+
+    def loaded(self):
+        """Return the keys of currently loaded models, least recently used first."""
+        with self._lock:
+            return list(self._entries.keys())
+
+    def total_nbytes(self):
+        with self._lock:
+            return sum(entry["nbytes"] for entry in self._entries.values())
+
+    def _evict(self, keep=None):
+        if self.memory_budget_bytes is None:
+            return
+        evicted = False
+        while self.total_nbytes() > self.memory_budget_bytes:
+            victim = next((key for key in self._entries if key != keep), None)
+            if victim is None:
+                break
+            print(f"evicting model {victim[0]} on {victim[1]} ({victim[2]})")
+            del self._entries[victim]
+            evicted = True
+        if evicted:
+            self._release_memory()
+
+    @staticmethod
+    def _release_memory():
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def _budget_from_env():
+    budget_mb = os.environ.get("MODEL_MEMORY_BUDGET_MB")
+    return int(budget_mb) * 2**20 if budget_mb else None
+
+
+# Shared by speech_to_text, text_to_speech and lipsync.
+registry = ModelRegistry(memory_budget_bytes=_budget_from_env())
@@ -0,0 +1,204 @@
+import os
+import time
+from types import SimpleNamespace
+
+import librosa
+import torch
+
+from frame_sinks import FfmpegPipeSink, FrameSink
+from llm import translate_segments
+from lipsync import Avatar, defaults, ensure_ffmpeg, load_models
+from media_io import read_audio
+from metrics import metrics
+from model_registry import registry
+from speech_to_text import transcribe_stream
+from text_to_speech import synthesize_segments
+
+STAGES = ("asr", "translate", "tts", "lipsync")
+
+
+class _ProgressSink(FrameSink):
+    """Forward frames to ``sink`` and report lipsync progress about once per second of video."""
+
+    def __init__(self, sink, progress, total_frames, every=25):
+        self.sink = sink
+        self.progress = progress
+        self.total_frames = max(1, total_frames)
+        self.every = every
+        self.frame_count = 0
+
+    def write(self, frame):
+        self.sink.write(frame)
+        self.frame_count += 1
+        if self.frame_count % self.every == 0:
+            self.progress("lipsync", min(1.0, self.frame_count / self.total_frames))
+
+    def close(self):
+        self.sink.close()
+
+    def abort(self):
+        self.sink.abort()
+
+
+def _no_progress(stage, fraction, **artifacts):
+    pass
+
+
+def warmup_models(tts_language="EN_NEWEST", **lipsync_options):
+    """
+    Load every model ``translate_video`` uses into the shared registry, so the
+    first request does not pay for loading. Arguments match ``translate_video``.
+    """
+    args = SimpleNamespace(**{**defaults, **lipsync_options})
+    ensure_ffmpeg(args.ffmpeg_path)
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    # Same keys as the defaults of transcribe_stream and _VoiceContext
+    registry.get("faster_whisper", device="cpu", dtype="int8", model_size="base.en", num_workers=2)
+    registry.get("tone_color_converter", device=device, ckpt_converter='checkpoints_v2/converter')
+    registry.get("melo_tts", device=device, language=tts_language)
+    load_models(args)
+
+
+def transcribe_video(video_path, language="en", progress=None):
+    """
+    ASR stage of ``translate_video``.
+    :param language: Language spoken in the video; English uses the English-only model.
+    :return: SimpleNamespace with the 16 kHz ``audio``, its ``duration`` in seconds,
+        the timestamped ``segments`` and the joined ``transcript``.
+    """
+    progress = progress or _no_progress
+    start_time = time.time()
+    source_audio = read_audio(video_path, sample_rate=16000)
+    print(f"decoded audio in {(time.time() - start_time) * 1000:.0f}ms")
+
+    duration = len(source_audio) / 16000
+    segments = []
+    progress("asr", 0.0)
+    model_size = "base.en" if language == "en" else "base"
+    for segment in transcribe_stream(source_audio, model_size=model_size, language=language):
+        segments.append(segment)
+        progress("asr", min(1.0, segment.end / duration), transcript=" ".join(s.text for s in segments))
+    if not segments:
+        raise RuntimeError(f"No speech found in {video_path}")
+    transcript = " ".join(segment.text for segment in segments)
+    progress("asr", 1.0, transcript=transcript)
+    return SimpleNamespace(audio=source_audio, duration=duration, segments=segments, transcript=transcript)
+
+
+def dub_transcript(segments, duration, source_language, target_language, reference_speaker,
+                   tts_language="EN_NEWEST", progress=None):
+    """
+    Translation and TTS stages of ``translate_video`` for one target language.
+    Each segment is translated and synthesized on its own and stretched to its
+    source span, so the dubbed track keeps the original timing and length.
+    :return: SimpleNamespace with ``segments`` (translated), ``translation``,
+        ``audio`` and ``sample_rate``.
+    """
+    progress = progress or _no_progress
+    progress("translate", 0.0)
+    translated_segments = translate_segments(segments, source_language, target_language)
+    translation = " ".join(segment.text for segment in translated_segments)
+    progress("translate", 1.0, translation=translation)
+
+    progress("tts", 0.0)
+    dubbed_audio, dubbed_sample_rate, _ = synthesize_segments(
+        translated_segments, reference_speaker, language=tts_language,
+        total_duration=duration,
+    )
+    progress("tts", 1.0, audio=dubbed_audio, sample_rate=dubbed_sample_rate)
+    return SimpleNamespace(segments=translated_segments, translation=translation,
+                           audio=dubbed_audio, sample_rate=dubbed_sample_rate)
+
+
+def lipsync_video(inference, output_path, dubbed, duration, fps=25, avatar_id=None, progress=None):
+    """
+    Lipsync stage of ``translate_video``: frames are piped into a single ffmpeg
+    process that also muxes the dubbed audio.
+    :param inference: Callable ``inference(audio, sink)`` lipsyncing a 16 kHz
+        float32 array into ``sink``, e.g. a bound ``Avatar.inference``.
+    :param dubbed: Result of ``dub_transcript``.
+    """
+    progress = progress or _no_progress
+    progress("lipsync", 0.0)
+    lipsync_audio = librosa.resample(dubbed.audio, orig_sr=dubbed.sample_rate, target_sr=16000)
+    sink = FfmpegPipeSink(output_path, fps=fps, audio=dubbed.audio, sample_rate=dubbed.sample_rate)
+    with _ProgressSink(sink, progress, total_frames=int(duration * fps), every=fps) as sink, \
+            metrics.span("lipsync", avatar=avatar_id):
+        inference(lipsync_audio, sink)
+    progress("lipsync", 1.0, output_path=output_path)
+
+
+def translate_video(
+    video_path: str,
+    output_path: str,
+    target_language: str,
+    source_language: str = "en",
+    reference_speaker: str = None,
+    avatar_id: str = None,
+    tts_language: str = "EN_NEWEST",
+    bbox_shift: int = 0,
+    batch_size: int = 20,
+    fps: int = 25,
+    progress=None,
+    **lipsync_options,
+):
+    """
+    Translate the speech in a video and lipsync the speaker to the dubbed audio.
+
+    Audio and frames are passed between stages in memory: the source audio is
+    decoded into a numpy buffer, TTS returns a waveform, and the lipsynced frames
+    are piped into a single ffmpeg process that also muxes the dubbed audio.
+    :param video_path: Input video of the speaker.
+    :param output_path: Where to write the translated mp4.
+    :param target_language: Language to translate into.
+    :param source_language: Language spoken in the input video.
+    :param reference_speaker: Audio/video file used to clone the voice (defaults to the input video).
+    :param avatar_id: Name of the prepared avatar (defaults to the video file name).
+    :param progress: Optional callback ``progress(stage, fraction, **artifacts)``, called as
+        each stage in ``STAGES`` advances. Partial results are passed as soon as they
+        exist: ``transcript`` during ASR, ``translation`` after translation,
+        ``audio``/``sample_rate`` after TTS and ``output_path`` once the video is written.
+    :param lipsync_options: Overrides for ``lipsync.defaults`` (version, gpu_id, model paths...).
+    :return: Dict with the transcript, translation, translated segments and output path.
+    """
+    args = SimpleNamespace(**{**defaults, **lipsync_options, "batch_size": batch_size, "fps": fps, "skip_save_images": True})
+    if avatar_id is None:
+        avatar_id = os.path.splitext(os.path.basename(video_path))[0]
+    if reference_speaker is None:
+        reference_speaker = video_path
+    ensure_ffmpeg(args.ffmpeg_path)
+
+    start_time = time.time()
+    transcription = transcribe_video(video_path, language=source_language, progress=progress)
+    dubbed = dub_transcript(
+        transcription.segments, transcription.duration, source_language, target_language,
+        reference_speaker, tts_language=tts_language, progress=progress,
+    )
+
+    models = load_models(args)
+    avatar = Avatar(
+        avatar_id=avatar_id,
+        video_path=video_path,
+        bbox_shift=bbox_shift,
+        batch_size=batch_size,
+        preparation=True,
+        unet=models.unet,
+        vae=models.vae,
+        audio_processor=models.audio_processor,
+        whisper=models.whisper,
+        pe=models.pe,
+        fp=models.fp,
+        args=args,
+    )
+    lipsync_video(
+        lambda audio, sink: avatar.inference(audio, out_vid_name=None, fps=fps, skip_save_images=True, sink=sink),
+        output_path, dubbed, transcription.duration, fps=fps, avatar_id=avatar_id, progress=progress,
+    )
+    print(f"translated video saved to {output_path} in {time.time() - start_time:.1f}s")
+
+    return {
+        "transcript": transcription.transcript,
+        "translation": dubbed.translation,
+        "segments": dubbed.segments,
+        "output_path": output_path,
+    }
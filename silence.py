@@ -0,0 +1,62 @@
+import numpy as np
+
+SAMPLING_RATE = 16000
+
+
+def frame_energy_db(audio, num_frames, fps=25):
+    """
+    RMS level of the audio under each video frame, in dB relative to full scale.
+    :param audio: Mono 16 kHz float32 array.
+    :return: (num_frames,) float array; frames past the end of the audio are -inf.
+    """
+    samples_per_frame = SAMPLING_RATE / fps
+    energy = np.full(num_frames, -np.inf)
+    for i in range(num_frames):
+        chunk = audio[int(round(i * samples_per_frame)):int(round((i + 1) * samples_per_frame))]
+        if len(chunk):
+            rms = np.sqrt(np.mean(np.square(chunk, dtype=np.float64)))
+            energy[i] = 20 * np.log10(max(rms, 1e-10))
+    return energy
+
+
+def generation_weights(audio, num_frames, fps=25, threshold_db=-35.0, min_silence_s=0.3, margin_frames=3, fade_frames=3):
+    """
+    Decide per frame whether the lipsync model needs to run.
+
+    A frame is silent when its level is ``threshold_db`` below the loudest frame.
+    Silent runs shorter than ``min_silence_s`` are ignored (short pauses between
+    words still move the mouth), and every run is shrunk by ``margin_frames`` on
+    both sides, because the model sees two frames of audio context either way.
+    Inside a silent run the generated face fades out over ``fade_frames`` frames
+    and back in before speech resumes, so there is no visible jump at the boundaries.
+    :return: (num_frames,) float array: 1 generate normally, 0 use the original
+        frame (no UNet/VAE), in between generate and blend with that weight.
+    """
+    energy = frame_energy_db(audio, num_frames, fps)
+    weights = np.ones(num_frames, dtype=np.float32)
+    if num_frames == 0 or not np.isfinite(energy).any():
+        return weights
+    silent = energy < np.max(energy[np.isfinite(energy)]) + threshold_db
+
+    min_silence_frames = int(round(min_silence_s * fps))
+    i = 0
+    while i < num_frames:
+        if not silent[i]:
+            i += 1
+            continue
+        j = i
+        while j < num_frames and silent[j]:
+            j += 1
+        # Keep generating next to speech; the stream start and end need no margin
+        start = i + margin_frames if i > 0 else i
+        end = j - margin_frames if j < num_frames else j
+        if j - i >= min_silence_frames and end > start:
+            weights[start:end] = 0.0
+            for k in range(fade_frames):
+                fade = 1.0 - (k + 1) / (fade_frames + 1)
+                if i > 0 and start + k < end:
+                    weights[start + k] = max(weights[start + k], fade)
+                if j < num_frames and end - 1 - k >= start:
+                    weights[end - 1 - k] = max(weights[end - 1 - k], fade)
+        i = j
+    return weights
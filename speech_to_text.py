@@ -1,9 +1,30 @@
-from faster_whisper import WhisperModel
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from faster_whisper import WhisperModel, decode_audio
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from metrics import metrics
+from model_registry import registry
+
+SAMPLING_RATE = 16000
+
+TranscriptSegment = collections.namedtuple("TranscriptSegment", ["start", "end", "text"])
+
+
+def _load_faster_whisper(device, compute_type, model_size="base.en", num_workers=1):
+    # num_workers > 1 lets several threads call transcribe() on the same model concurrently
+    return WhisperModel(model_size, device=device, compute_type=compute_type, num_workers=num_workers)
+
+
+registry.register("faster_whisper", _load_faster_whisper)
+
 
 def speech_to_text(audio_file_path):
     """
     Transcribe audio to text using the Whisper model.
-    :param audio_file_path: Path to the audio file (WAV format).
+    :param audio_file_path: Path to the audio file, or a mono 16 kHz float32 numpy array.
     :return: Transcribed text.
     """
 
@@ -20,32 +41,16 @@ def speech_to_text(audio_file_path):
     device = "cpu" # or "cuda" if you have a compatible GPU and CUDA installed
     compute_type = "int8" # or "float16" for GPU
 
-    # 3. Load the model
-    try:
-        model = WhisperModel(model_size, device=device, compute_type=compute_type)
-        print(f"Model '{model_size}' loaded successfully on {device} with compute type {compute_type}.")
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        exit()
-
-    # 4. Specify the path to your .wav file
-    audio_file_path = 'resources/sepideh_voice_test.mp3' # Make sure this file exists
-
-    # 5. Transcribe the audio file
-    print(f"Transcribing {audio_file_path}...")
+    # 3. Transcribe the audio file. The model is loaded once through the shared registry,
+    #    the audio is split on silences and chunks are decoded in parallel.
+    source_name = audio_file_path if isinstance(audio_file_path, str) else "in-memory audio"
+    print(f"Transcribing {source_name} with '{model_size}' on {device} ({compute_type})...")
     try:
-        # The transcribe method takes the audio file path directly
-        segments, info = model.transcribe(audio_file_path, beam_size=5)
-
-        # segments is an iterator yielding named tuples with start, end, and text
-        # info contains detected language and probability
-
-        print(f"\nDetected language: {info.language} (Probability: {info.language_probability:.2f})")
         print("Transcription:")
         full_transcript = []
-        for segment in segments:
+        for segment in transcribe_stream(audio_file_path, model_size=model_size, device=device, compute_type=compute_type):
             print(f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}")
-            full_transcript.append(segment.text.strip())
+            full_transcript.append(segment.text)
 
         print("\nFull Transcript:")
         print(" ".join(full_transcript))
@@ -56,4 +61,112 @@ def speech_to_text(audio_file_path):
     except Exception as e:
         print(f"An error occurred during transcription: {e}")
         
-    return None
\ No newline at end of file
+    return None
+
+
+def _group_speech(speech, max_samples):
+    """Merge consecutive VAD speech regions into chunks of at most ``max_samples``."""
+    chunks = []
+    for region in speech:
+        start, end = region["start"], region["end"]
+        # A single region longer than the limit is cut into pieces
+        while end - start > max_samples:
+            chunks.append((start, start + max_samples))
+            start += max_samples
+        if chunks and end - chunks[-1][0] <= max_samples:
+            chunks[-1] = (chunks[-1][0], end)
+        else:
+            chunks.append((start, end))
+    return chunks
+
+
+def _vad_chunks(audio, vad_options, max_samples, offset=0):
+    speech = get_speech_timestamps(audio, vad_options=vad_options)
+    for start, end in _group_speech(speech, max_samples):
+        yield offset + start, audio[start:end]
+
+
+def _vad_chunks_from_stream(pieces, vad_options, max_samples):
+    """
+    Cut a live stream of audio pieces into speech chunks. A chunk is released
+    once it is followed by enough silence, or once the buffer reaches
+    ``max_samples`` so latency stays bounded during continuous speech.
+    """
+    min_silence = int(vad_options.min_silence_duration_ms * SAMPLING_RATE / 1000)
+    buffer = np.zeros(0, dtype=np.float32)
+    offset = 0
+    for piece in pieces:
+        buffer = np.concatenate([buffer, np.asarray(piece, dtype=np.float32)])
+        if len(buffer) < SAMPLING_RATE:
+            continue
+        speech = get_speech_timestamps(buffer, vad_options=vad_options)
+        complete = [region for region in speech if region["end"] <= len(buffer) - min_silence]
+        if complete:
+            cut = complete[-1]["end"]
+        elif len(buffer) >= max_samples:
+            complete, cut = speech, len(buffer)
+        else:
+            continue
+        for start, end in _group_speech(complete, max_samples):
+            yield offset + start, buffer[start:end]
+        buffer = buffer[cut:]
+        offset += cut
+    if len(buffer):
+        yield from _vad_chunks(buffer, vad_options, max_samples, offset=offset)
+
+
+def _transcribe_chunk(model, chunk, start_sample, beam_size, language):
+    start_s = start_sample / SAMPLING_RATE
+    with metrics.span("asr", start_s=round(start_s, 2), audio_s=round(len(chunk) / SAMPLING_RATE, 2)):
+        segments, _ = model.transcribe(chunk, beam_size=beam_size, language=language, vad_filter=False)
+        # faster-whisper decodes lazily; consume the generator inside the span
+        return [
+            TranscriptSegment(start_s + segment.start, start_s + segment.end, segment.text.strip())
+            for segment in segments
+        ]
+
+
+def transcribe_stream(
+    audio,
+    model_size="base.en",
+    device="cpu",
+    compute_type="int8",
+    num_workers=2,
+    beam_size=5,
+    language=None,
+    max_chunk_s=30,
+    min_silence_duration_ms=500,
+):
+    """
+    Transcribe audio chunk by chunk and yield timestamped segments as soon as
+    they are ready, so translation can start before the whole transcript exists.
+
+    The audio is split on VAD silence boundaries into chunks of at most
+    ``max_chunk_s`` seconds, and chunks are decoded in parallel by ``num_workers``
+    threads sharing one model. Segments are yielded in order.
+    :param audio: Path to an audio/video file, a mono 16 kHz float32 numpy array,
+        or an iterable of such arrays arriving live.
+    :return: Generator of ``TranscriptSegment(start, end, text)`` with times in seconds.
+    """
+    model = registry.get("faster_whisper", device=device, dtype=compute_type,
+                         model_size=model_size, num_workers=num_workers)
+    vad_options = VadOptions(min_silence_duration_ms=min_silence_duration_ms)
+    max_samples = int(max_chunk_s * SAMPLING_RATE)
+
+    if isinstance(audio, str):
+        chunks = _vad_chunks(decode_audio(audio, sampling_rate=SAMPLING_RATE), vad_options, max_samples)
+    elif isinstance(audio, np.ndarray):
+        chunks = _vad_chunks(audio.astype(np.float32, copy=False), vad_options, max_samples)
+    else:
+        chunks = _vad_chunks_from_stream(audio, vad_options, max_samples)
+
+    # Keep a bounded number of chunks in flight and release results in order
+    max_in_flight = 2 * num_workers
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start_sample, chunk in chunks:
+            pending.append(executor.submit(_transcribe_chunk, model, chunk, start_sample, beam_size, language))
+            while pending and (pending[0].done() or len(pending) >= max_in_flight):
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -1,46 +1,257 @@
+import io
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import librosa
+import numpy as np
+import soundfile
 import torch
 from melo.api import TTS
 from OpenVoice.openvoice import se_extractor
 from OpenVoice.openvoice.api import ToneColorConverter
 
-def text_to_speech(text, source_speaker_file, language="EN_NEWEST"):
-    ckpt_converter = 'checkpoints_v2/converter'
-    device = "cuda:0" if torch.cuda.is_available() else "cpu"
-    output_dir = 'outputs_v2'
+from hashing import cached_file_sha256, params_hash
+from metrics import metrics
+from model_registry import registry
+from workspace import new_request_id, request_workspace, unique_tmp_path
 
+
+def _load_tone_color_converter(device, dtype, ckpt_converter='checkpoints_v2/converter'):
     tone_color_converter = ToneColorConverter(f'{ckpt_converter}/config.json', device=device)
     tone_color_converter.load_ckpt(f'{ckpt_converter}/checkpoint.pth')
+    return tone_color_converter
 
-    os.makedirs(output_dir, exist_ok=True)
 
-    reference_speaker = f'resources/{source_speaker_file}'
-    target_se, audio_name = se_extractor.get_se(reference_speaker, tone_color_converter, vad=True)    
+def _load_melo_tts(device, dtype, language="EN_NEWEST"):
+    return TTS(language=language, device=device)
+
+
+registry.register("tone_color_converter", _load_tone_color_converter)
+registry.register("melo_tts", _load_melo_tts)
+
+# melo TTS language for ISO 639-1 codes and English language names
+MELO_LANGUAGES = {
+    "en": "EN_NEWEST", "english": "EN_NEWEST",
+    "es": "ES", "spanish": "ES",
+    "fr": "FR", "french": "FR",
+    "zh": "ZH", "chinese": "ZH",
+    "ja": "JP", "japanese": "JP",
+    "ko": "KR", "korean": "KR",
+}
+
+
+def melo_language(language, default="EN_NEWEST"):
+    """melo TTS language to speak ``language`` (a code or name); ``default`` when melo has no model for it."""
+    melo = MELO_LANGUAGES.get(language.strip().lower())
+    if melo is None:
+        print(f"no melo TTS model for {language}, speaking it with {default}")
+        return default
+    return melo
+
+
+class SpeakerEmbeddingCache:
+    """
+    Tone-color embeddings kept in memory (LRU, ``max_entries``) and on disk.
+
+    Embeddings are deterministic for a given reference audio and converter
+    checkpoint, so they are keyed by the content hash of both. Disk entries
+    survive restarts; memory entries skip even the ``torch.load``.
+    """
+
+    def __init__(self, directory="cache/speaker_embeddings", max_entries=64):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, device):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.cache_lookup("speaker_embedding", True)
+                return self._entries[key]
+
+        path = os.path.join(self.directory, f"{key}.pt")
+        metrics.cache_lookup("speaker_embedding", os.path.exists(path))
+        if os.path.exists(path):
+            embedding = torch.load(path, map_location=device)
+        else:
+            embedding = compute()
+            # Created on first write, so importing this module touches no disk
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = unique_tmp_path(path)
+            torch.save(embedding.detach().cpu(), tmp_path)
+            os.replace(tmp_path, path)
+        embedding = embedding.to(device)
+
+        with self._lock:
+            self._entries[key] = embedding
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return embedding
+
+
+speaker_embedding_cache = SpeakerEmbeddingCache()
+_base_speaker_ses = {}
+
+
+def _extract_se(reference_speaker, tone_color_converter):
+    # get_se writes VAD segments under target_dir; keep them private to this call
+    with request_workspace(prefix="v2v-se-") as workspace:
+        target_se, _ = se_extractor.get_se(reference_speaker, tone_color_converter, target_dir=workspace, vad=True)
+    return target_se
+
+
+def get_target_se(reference_speaker, tone_color_converter, device, ckpt_converter='checkpoints_v2/converter'):
+    """Embedding of the reference voice; VAD and extraction only run on a cache miss."""
+    key = params_hash(
+        "target_se",
+        cached_file_sha256(reference_speaker),
+        cached_file_sha256(f'{ckpt_converter}/checkpoint.pth'),
+    )
+    return speaker_embedding_cache.get(
+        key,
+        lambda: _extract_se(reference_speaker, tone_color_converter),
+        device,
+    )
+
+
+def get_source_se(speaker_key, device):
+    """Base-speaker embedding shipped with the checkpoints, loaded once per device."""
+    cache_key = (speaker_key, str(device))
+    if cache_key not in _base_speaker_ses:
+        _base_speaker_ses[cache_key] = torch.load(f'checkpoints_v2/base_speakers/ses/{speaker_key}.pth', map_location=device)
+    return _base_speaker_ses[cache_key]
 
-    src_path = f'{output_dir}/tmp.wav'
 
+def _wav_buffer(audio, sample_rate):
+    buffer = io.BytesIO()
+    soundfile.write(buffer, audio, sample_rate, format="WAV")
+    buffer.seek(0)
+    return buffer
+
+
+class _VoiceContext:
+    """Models and embeddings needed to speak in one reference voice."""
+
+    def __init__(self, reference_speaker, language="EN_NEWEST"):
+        ckpt_converter = 'checkpoints_v2/converter'
+        self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+        self.tone_color_converter = registry.get("tone_color_converter", device=self.device, ckpt_converter=ckpt_converter)
+        self.target_se = get_target_se(reference_speaker, self.tone_color_converter, self.device, ckpt_converter=ckpt_converter)
+
+        self.model = registry.get("melo_tts", device=self.device, language=language)
+        speaker_ids = self.model.hps.data.spk2id
+        speaker_key = list(speaker_ids.keys())[0]
+
+        self.speaker_id = speaker_ids[speaker_key]
+        speaker_key = speaker_key.lower().replace('_', '-')
+
+        self.source_se = get_source_se(speaker_key, self.device)
+        if torch.backends.mps.is_available() and self.device == 'cpu':
+            torch.backends.mps.is_available = lambda: False
+        self.sample_rate = self.tone_color_converter.hps.data.sampling_rate
+
+    def speak(self, text, speed=1.0):
+        # With no output path melo returns the waveform instead of writing it
+        with metrics.span("tts", chars=len(text)):
+            src_audio = self.model.tts_to_file(text, self.speaker_id, None, speed=speed, quiet=True)
+
+        # Run the tone color converter on an in-memory wav
+        encode_message = "@MyShell"
+        with metrics.span("tone_conversion"):
+            return self.tone_color_converter.convert(
+                audio_src_path=_wav_buffer(src_audio, self.model.hps.data.sampling_rate),
+                src_se=self.source_se,
+                tgt_se=self.target_se,
+                output_path=None,
+                message=encode_message
+            )
+
+
+def synthesize_speech(text, reference_speaker, language="EN_NEWEST"):
+    """
+    Synthesize ``text`` in the voice of ``reference_speaker`` without touching disk.
+    :param text: Text to speak.
+    :param reference_speaker: Path to an audio or video file of the target voice.
+    :param language: melo TTS language.
+    :return: (audio, sample_rate) with audio as a mono float32 numpy array.
+    """
+    voice = _VoiceContext(reference_speaker, language=language)
     # Speed is adjustable
     speed = 1.0
+    return voice.speak(text, speed=speed), voice.sample_rate
 
-    model = TTS(language=language, device=device)
-    speaker_ids = model.hps.data.spk2id
-    speaker_key = list(speaker_ids.keys())[0]
-
-    speaker_id = speaker_ids[speaker_key]
-    speaker_key = speaker_key.lower().replace('_', '-')
-    
-    source_se = torch.load(f'checkpoints_v2/base_speakers/ses/{speaker_key}.pth', map_location=device)
-    if torch.backends.mps.is_available() and device == 'cpu':
-        torch.backends.mps.is_available = lambda: False
-    model.tts_to_file(text, speaker_id, src_path, speed=speed)
-    save_path = f'{output_dir}/output_{source_speaker_file[:-4]}_translated.wav'
-
-    # Run the tone color converter
-    encode_message = "@MyShell"
-    tone_color_converter.convert(
-        audio_src_path=src_path, 
-        src_se=source_se, 
-        tgt_se=target_se, 
-        output_path=save_path,
-        message=encode_message
-    )
+
+def fit_duration(audio, target_samples, min_rate=0.5, max_rate=2.0):
+    """
+    Time-stretch ``audio`` (pitch preserved) so it lasts ``target_samples``,
+    then pad or trim to exactly that length. The rate is clamped so extreme
+    mismatches do not produce unintelligible speech.
+    """
+    if target_samples <= 0:
+        return np.zeros(0, dtype=np.float32)
+    if len(audio) > 0:
+        rate = float(np.clip(len(audio) / target_samples, min_rate, max_rate))
+        if abs(rate - 1.0) > 0.01:
+            audio = librosa.effects.time_stretch(audio, rate=rate)
+    audio = audio[:target_samples]
+    return np.pad(audio, (0, target_samples - len(audio))).astype(np.float32)
+
+
+def assemble_track(segments, segment_audios, sample_rate, total_duration=None):
+    """Place each segment's audio at its start time on a silent track."""
+    end = max((segment.end for segment in segments), default=0.0)
+    total_samples = int(round(max(total_duration or 0.0, end) * sample_rate))
+    track = np.zeros(total_samples, dtype=np.float32)
+    for segment, audio in zip(segments, segment_audios):
+        start = int(round(segment.start * sample_rate))
+        audio = audio[:max(0, total_samples - start)]
+        track[start:start + len(audio)] = audio
+    return track
+
+
+def synthesize_segments(segments, reference_speaker, language="EN_NEWEST", num_workers=2,
+                        fit_to_timestamps=True, total_duration=None):
+    """
+    Synthesize translated segments concurrently, tone-convert each one and,
+    with ``fit_to_timestamps``, stretch each to its source span so the dubbed
+    track stays aligned with the original video.
+    :param segments: Objects with ``start``, ``end`` (seconds) and ``text``,
+        e.g. ``speech_to_text.TranscriptSegment``.
+    :param total_duration: Length of the output track in seconds (e.g. the video length).
+    :return: (track, sample_rate, segment_audios); all arrays are mono float32.
+    """
+    voice = _VoiceContext(reference_speaker, language=language)
+
+    def synthesize(segment):
+        if not segment.text.strip():
+            return np.zeros(0, dtype=np.float32)
+        audio = voice.speak(segment.text)
+        if fit_to_timestamps:
+            audio = fit_duration(audio, int(round((segment.end - segment.start) * voice.sample_rate)))
+        return audio
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        segment_audios = list(executor.map(synthesize, segments))
+    track = assemble_track(segments, segment_audios, voice.sample_rate, total_duration=total_duration)
+    return track, voice.sample_rate, segment_audios
+
+
+def text_to_speech(text, source_speaker_file, language="EN_NEWEST", request_id=None):
+    output_dir = 'outputs_v2'
+    os.makedirs(output_dir, exist_ok=True)
+
+    reference_speaker = f'resources/{source_speaker_file}'
+    audio, sample_rate = synthesize_speech(text, reference_speaker, language=language)
+
+    # The request id keeps concurrent translations of the same speaker apart
+    request_id = request_id or new_request_id()
+    save_path = f'{output_dir}/output_{os.path.splitext(source_speaker_file)[0]}_translated_{request_id}.wav'
+    tmp_path = unique_tmp_path(save_path)
+    soundfile.write(tmp_path, audio, sample_rate)
+    os.replace(tmp_path, save_path)
+    return save_path
@@ -0,0 +1,211 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from hashing import array_sha256, cached_file_sha256, params_hash
+from metrics import metrics
+from workspace import unique_tmp_path
+
+SAMPLING_RATE = 16000
+# Whisper encoder output rate: one feature every 20 ms
+FEATURE_RATE = 50
+SAMPLES_PER_FEATURE = SAMPLING_RATE // FEATURE_RATE
+# The encoder always sees a 30 s window
+WINDOW_SAMPLES = 30 * SAMPLING_RATE
+
+
+class WhisperFeatureStream:
+    """
+    Incremental version of ``AudioProcessor.get_audio_feature`` + ``get_whisper_chunk``.
+
+    Audio is pushed in small chunks; every call returns the per-frame audio
+    prompts that can be computed so far. Frame ``i`` needs
+    ``audio_padding_length_right`` frames of look-ahead, so it is emitted as soon
+    as the audio reaches roughly ``(i + 1 + audio_padding_length_right) / fps``
+    seconds (120 ms after the frame with the defaults). Each encoder pass sees
+    ``context_s`` seconds of earlier audio for left context; the start of the
+    stream is zero-padded exactly like the offline path, and ``flush`` pads the end.
+    """
+
+    def __init__(self, audio_processor, whisper, device, weight_dtype, fps=25,
+                 audio_padding_length_left=2, audio_padding_length_right=2, context_s=1.0):
+        self.audio_processor = audio_processor
+        self.whisper = whisper
+        self.device = device
+        self.weight_dtype = weight_dtype
+        self.fps = int(fps)
+        self.multiplier = FEATURE_RATE / self.fps
+        self.left_offset = math.ceil(self.multiplier) * audio_padding_length_left
+        self.clip_length = 2 * (audio_padding_length_left + audio_padding_length_right + 1)
+        self.context_features = int(context_s * FEATURE_RATE)
+        # Frames per encoder pass, so context + frames + look-ahead fit in one 30 s window
+        self.max_frames = max(1, int((30 - context_s - self.clip_length / FEATURE_RATE) * self.fps) - 1)
+
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._buffer_start = 0  # sample index of _buffer[0]
+        self._total_samples = 0
+        self._next_frame = 0
+        self._ended = False
+
+    @property
+    def frames_emitted(self):
+        return self._next_frame
+
+    def _clip_start(self, frame_index):
+        # Feature index of the first feature in the frame's prompt (may be negative: left padding)
+        return math.floor(frame_index * self.multiplier) - self.left_offset
+
+    def _ready_frames(self):
+        if self._ended:
+            return math.floor(self._total_samples / SAMPLING_RATE * self.fps)
+        available = self._total_samples // SAMPLES_PER_FEATURE
+        frame_count = self._next_frame
+        while self._clip_start(frame_count) + self.clip_length <= available:
+            frame_count += 1
+        return frame_count
+
+    def _encode(self, first, last):
+        """Encoder hidden states for feature indices [first, last), zero outside the audio."""
+        limit = math.floor(self._total_samples / SAMPLING_RATE * FEATURE_RATE) if self._ended \
+            else self._total_samples // SAMPLES_PER_FEATURE
+        start, end = max(first, 0), min(last, limit)
+        parts = []
+        if end > start:
+            window_start = max(self._buffer_start // SAMPLES_PER_FEATURE, start - self.context_features)
+            window_start_sample = window_start * SAMPLES_PER_FEATURE
+            window_end_sample = min(self._total_samples, window_start_sample + WINDOW_SAMPLES)
+            audio = self._buffer[window_start_sample - self._buffer_start:window_end_sample - self._buffer_start]
+            with metrics.span("whisper_features", streaming=True):
+                input_features = self.audio_processor.feature_extractor(
+                    audio, return_tensors="pt", sampling_rate=SAMPLING_RATE
+                ).input_features.to(device=self.device, dtype=self.weight_dtype)
+                hidden_states = self.whisper.encoder(input_features, output_hidden_states=True).hidden_states
+            encoded = torch.stack(hidden_states, dim=2)[0]  # (1500, layers, dim)
+            parts.append(encoded[start - window_start:end - window_start])
+            feature_shape = tuple(encoded.shape[1:])
+        else:
+            feature_shape = (self.whisper.config.encoder_layers + 1, self.whisper.config.d_model)
+
+        # Zeros before the start of the audio (left padding) and after its end (right padding)
+        num_left = max(0, min(last, 0) - first)
+        num_right = (last - first) - num_left - max(0, end - start)
+        if num_left:
+            parts.insert(0, torch.zeros((num_left,) + feature_shape, device=self.device, dtype=self.weight_dtype))
+        if num_right:
+            parts.append(torch.zeros((num_right,) + feature_shape, device=self.device, dtype=self.weight_dtype))
+        return torch.cat(parts)
+
+    def _emit(self):
+        ready = self._ready_frames()
+        prompts = []
+        while self._next_frame < ready:
+            first_frame = self._next_frame
+            last_frame = min(ready, first_frame + self.max_frames)
+            first = self._clip_start(first_frame)
+            last = self._clip_start(last_frame - 1) + self.clip_length
+            features = self._encode(first, last)
+            for frame_index in range(first_frame, last_frame):
+                offset = self._clip_start(frame_index) - first
+                prompts.append(features[offset:offset + self.clip_length])
+            self._next_frame = last_frame
+        self._trim()
+        if not prompts:
+            return None
+        prompts = torch.stack(prompts)  # T, 10, layers, dim
+        return prompts.reshape(prompts.shape[0], -1, prompts.shape[-1])
+
+    def _trim(self):
+        # Keep the next frame's features plus the left context
+        keep_feature = max(0, self._clip_start(self._next_frame) - self.context_features)
+        keep_sample = keep_feature * SAMPLES_PER_FEATURE
+        if keep_sample > self._buffer_start:
+            self._buffer = self._buffer[keep_sample - self._buffer_start:]
+            self._buffer_start = keep_sample
+
+    def push(self, samples):
+        """
+        Add mono 16 kHz float32 samples.
+        :return: (T, 50, 384) audio prompts for the frames that became ready, or None.
+        """
+        if self._ended:
+            raise RuntimeError("push after flush")
+        samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+        self._buffer = np.concatenate([self._buffer, samples])
+        self._total_samples += len(samples)
+        return self._emit()
+
+    def flush(self):
+        """End of audio: return the prompts of the remaining frames, zero-padded on the right."""
+        self._ended = True
+        return self._emit()
+
+
+def audio_key(audio):
+    """Content hash of an audio file path or a mono 16 kHz float32 array."""
+    if isinstance(audio, str):
+        return cached_file_sha256(audio)
+    return array_sha256(np.asarray(audio, dtype=np.float32))
+
+
+class WhisperChunkCache:
+    """
+    Per-frame Whisper audio prompts (``get_whisper_chunk`` output) kept in memory
+    and on disk, keyed by audio content hash, encoder, dtype, fps and padding.
+
+    The prompts depend only on the audio, not on the avatar, so re-rendering the
+    same track on another avatar, or retrying a request, skips audio processing.
+    Memory entries are kept on the CPU in LRU order up to ``max_bytes``; disk
+    entries survive restarts. Set ``directory`` to None for a memory-only cache.
+    """
+
+    def __init__(self, directory="cache/whisper_chunks", max_bytes=512 * 1024 ** 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(audio_hash, whisper_dir, weight_dtype, fps, audio_padding_length_left, audio_padding_length_right):
+        return params_hash("whisper_chunks", audio_hash, whisper_dir, str(weight_dtype), int(fps),
+                           audio_padding_length_left, audio_padding_length_right)
+
+    def get(self, key, compute, device):
+        """
+        Return the cached prompts for ``key`` on ``device``, or ``compute()`` and store them.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.cache_lookup("whisper_chunks", True)
+                return self._entries[key].to(device)
+
+        path = os.path.join(self.directory, f"{key}.pt") if self.directory is not None else None
+        metrics.cache_lookup("whisper_chunks", path is not None and os.path.exists(path))
+        if path is not None and os.path.exists(path):
+            chunks = torch.load(path, map_location="cpu")
+        else:
+            chunks = compute().detach().cpu()
+            if path is not None:
+                # Created on first write, so importing this module touches no disk
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = unique_tmp_path(path)
+                torch.save(chunks, tmp_path)
+                os.replace(tmp_path, path)
+
+        nbytes = chunks.numel() * chunks.element_size()
+        with self._lock:
+            if key not in self._entries and nbytes <= self.max_bytes:
+                self._entries[key] = chunks
+                self._nbytes += nbytes
+                while self._nbytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._nbytes -= evicted.numel() * evicted.element_size()
+        return chunks.to(device)
+
+
+whisper_chunk_cache = WhisperChunkCache()
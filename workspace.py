@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def request_workspace(prefix="v2v-", root=None):
+    """
+    Private scratch directory for one request, removed on exit even on failure.
+    Concurrent requests never share intermediate files.
+    """
+    path = tempfile.mkdtemp(prefix=prefix, dir=root)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def unique_tmp_path(path):
+    """
+    Sibling of ``path`` to write to before an atomic ``os.replace``. Unique per
+    process and call, so concurrent writers of the same target never collide.
+    The extension is kept so tools that infer formats from it (ffmpeg) still work.
+    """
+    root, ext = os.path.splitext(path.rstrip("/"))
+    return f"{root}.partial-{os.getpid()}-{uuid.uuid4().hex[:8]}{ext}"